@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the accept and response throughput of the gevent and asyncio
+engines.
+
+A herald process is started for each engine with a cached stub plugin and
+loaded with concurrent agent checks.
+
+    $ python benchmarks/bench_engines.py -c 200 -d 10
+
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from loadgen import load, summarize, report
+from harness import stub_config, stub_plugin, start_herald, stop_herald
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-p', '--port', default=15555, type=int)
+    parser.add_argument('-c', '--concurrency', default=200, type=int,
+                        help='concurrent connections')
+    parser.add_argument('-P', '--processes', default=1, type=int,
+                        help='load generating processes')
+    parser.add_argument('-d', '--duration', default=10, type=float,
+                        help='seconds to run each engine for')
+    args = parser.parse_args()
+
+    config = stub_config(args.port, [stub_plugin('stub', interval=1)])
+    for engine in ('gevent', 'asyncio'):
+        process = start_herald(config, engine)
+        try:
+            latencies, errors = load('127.0.0.1', args.port,
+                                     args.concurrency, args.duration,
+                                     processes=args.processes)
+        finally:
+            stop_herald(process)
+        report(engine, summarize(latencies, errors, args.duration))
+
+
+if __name__ == '__main__':
+    main()
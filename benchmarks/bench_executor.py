@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares agent check latency while a plugin does CPU heavy runs on the hub,
+in the thread executor and in the process executor.
+
+A herald process is started for each executor with a stub plugin decoding
+a large JSON payload every interval, and loaded with concurrent agent
+checks. Runs on the hub delay the responses for as long as they decode.
+
+    $ python benchmarks/bench_executor.py -s 20000000 -d 10
+
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from loadgen import load, summarize, report
+from harness import stub_config, stub_plugin, start_herald, stop_herald
+
+EXECUTORS = ('hub', 'thread', 'process')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-p', '--port', default=15555, type=int)
+    parser.add_argument('-c', '--concurrency', default=50, type=int,
+                        help='concurrent connections')
+    parser.add_argument('-d', '--duration', default=10, type=float,
+                        help='seconds to run each executor for')
+    parser.add_argument('-s', '--payload-size', default=20000000, type=int,
+                        help='bytes of JSON decoded by every run')
+    parser.add_argument('-i', '--interval', default=1, type=int,
+                        help='plugin interval')
+    parser.add_argument('-e', '--engine', default='gevent',
+                        choices=['gevent', 'asyncio'])
+    args = parser.parse_args()
+
+    for executor in EXECUTORS:
+        plugin = stub_plugin('stub', interval=args.interval,
+                             run_timeout=0, payload_size=args.payload_size)
+        if executor != 'hub':
+            plugin['executor'] = executor
+        config = stub_config(args.port, [plugin])
+        process = start_herald(config, args.engine)
+        try:
+            latencies, errors = load('127.0.0.1', args.port,
+                                     args.concurrency, args.duration)
+        finally:
+            stop_herald(process)
+        report(executor, summarize(latencies, errors, args.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for projected JSON parsing of large health payloads.
+
+Compares json.loads, the full parse (orjson when installed) and the
+projection of the key a thresholds metric reads, with that key placed first,
+in the middle or last of a payload of many nested entries. Reports the time
+and the peak memory allocated per parse.
+
+    $ python benchmarks/bench_json.py -e 20000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from herald import projection
+from herald.rules import metric_key_paths
+
+METRIC = "r['stats']['msg-rate']"
+
+
+def make_payload(entries, position):
+    items = [('backend{}'.format(i), {'status': 'healthy', 'latency': i,
+                                      'tags': ['tag{}'.format(j)
+                                               for j in range(16)]})
+             for i in range(entries)]
+    index = {'first': 0, 'middle': entries // 2, 'last': entries}[position]
+    items.insert(index, ('stats', {'msg-rate': 4200, 'errors': 0}))
+    return json.dumps(dict(items))
+
+
+def measure(func, text, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(text)
+    elapsed = (time.perf_counter() - start) / iterations
+    tracemalloc.start()
+    func(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-e', '--entries', default=20000, type=int,
+                        help='number of entries in the payload')
+    parser.add_argument('-n', '--iterations', default=5, type=int)
+    args = parser.parse_args()
+
+    project = projection.Projection(metric_key_paths(METRIC)).loads
+    parsers = [('json.loads', json.loads),
+               ('orjson' if projection.orjson else 'full', projection.loads),
+               ('projection', project)]
+    for position in ('first', 'middle', 'last'):
+        text = make_payload(args.entries, position)
+        assert project(text)['stats'] == {'msg-rate': 4200}
+        print('{} key, {:.1f} MB payload'.format(position, len(text) / 1e6))
+        for name, func in parsers:
+            elapsed, peak = measure(func, text, args.iterations)
+            print('  {:<12} {:>8.1f} ms {:>8.1f} MB peak'.format(
+                name, elapsed * 1000, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for HeraldPatterns with many rules and long health strings.
+
+Compares the previous evaluation, matching the uncompiled pattern of each
+rule in turn, with the combined single pass matcher. The health strings are
+built so the match lands early, in the middle, at the end, or nowhere.
+
+    $ python benchmarks/bench_patterns.py -r 60 -l 4096
+
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import random
+import string
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from herald.rules import HeraldPatterns
+
+
+def legacy_process_rules(rules, value):
+    for rule in rules:
+        action, pattern = list(rule.items())[0]
+        if re.match(pattern, str(value)):
+            return action
+    else:
+        return None
+
+
+def make_rules(count):
+    return [{'state{}'.format(i): '.*status=code{}(?:;|$)'.format(i)}
+            for i in range(count)]
+
+
+def make_values(count, length):
+    filler = ''.join(random.choice(string.ascii_lowercase + ' ')
+                     for _ in range(length))
+    codes = [0, count // 2, count - 1, count + 1]
+    return [filler + ' status=code{};'.format(code) for code in codes]
+
+
+def measure(func, values, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for value in values:
+            func(value)
+    return iterations * len(values) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-r', '--rules', default=60, type=int,
+                        help='number of pattern rules')
+    parser.add_argument('-l', '--length', default=4096, type=int,
+                        help='length of the health strings')
+    parser.add_argument('-n', '--iterations', default=200, type=int)
+    args = parser.parse_args()
+
+    rules = make_rules(args.rules)
+    values = make_values(args.rules, args.length)
+    patterns = HeraldPatterns(rules, 'r')
+    for value in values:
+        assert patterns.process_rules(value) == \
+            legacy_process_rules(rules, value)
+
+    before = measure(lambda v: legacy_process_rules(rules, v), values,
+                     args.iterations)
+    after = measure(patterns.process_rules, values, args.iterations)
+    print('{} rules, {} char values'.format(args.rules, args.length))
+    print('before: {:>10,.0f} evaluations/sec'.format(before))
+    print('after:  {:>10,.0f} evaluations/sec'.format(after))
+    print('speedup: {:.2f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
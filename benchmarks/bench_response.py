@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for the agent check response path.
+
+Compares the previous `handle_requests` path, which called `respond`,
+formatted a debug string and encoded the state on every connection, with the
+pre-rendered `respond_bytes` path. Connections are simulated with an in
+memory socket so only herald's own per connection cost is measured.
+
+    $ python benchmarks/bench_response.py -n 200000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from herald import herald
+from herald.baseplugin import HeraldPlugin
+
+
+class StaticPlugin(HeraldPlugin):
+
+    herald_plugin_name = 'bench_response_static'
+
+    def run(self):
+        return {'rate': 3500}
+
+
+class FakeSocket(object):
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        return b''
+
+    def send(self, data):
+        return len(data)
+
+    sendall = send
+
+
+def legacy_handle_requests(socket, addr, plugin):
+    logger = herald.logger
+    logger.debug("received connect from {}".format(addr))
+    state = plugin.respond()
+    logger.debug("writing state: {}".format(state))
+    socket.send((str(state) + "\n").encode('UTF-8'))
+
+
+def measure(handler, count):
+    socket = FakeSocket()
+    addr = ('127.0.0.1', 40000)
+    start = time.perf_counter()
+    for _ in range(count):
+        handler(socket, addr)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--count', default=200000, type=int,
+                        help='connections to simulate per run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    herald.logger = logging.getLogger('Herald')
+
+    plugin = StaticPlugin(name='bench', interval=5,
+                          thresholds_metric="r['rate']",
+                          thresholds=[{'pct': 7000}])
+    plugin.write_state(plugin.process_rules(plugin.run()))
+    routes = herald.build_routes({'name': 'bench'}, [plugin])
+
+    def legacy(socket, addr):
+        legacy_handle_requests(socket, addr, plugin)
+
+    def current(socket, addr):
+        herald.handle_requests(socket, addr, routes, plugin, 0)
+
+    before = measure(legacy, args.count)
+    after = measure(current, args.count)
+    print('before: {:>12,.0f} connections/sec'.format(before))
+    print('after:  {:>12,.0f} connections/sec'.format(after))
+    print('speedup: {:.2f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
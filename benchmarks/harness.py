@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to start a real herald process with stub plugins for benchmarking.
+
+"""
+
+import os
+import sys
+import yaml
+import tempfile
+import subprocess
+
+from loadgen import wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+
+def stub_config(port, plugins, **kwargs):
+    """
+    Returns a herald config dict serving the passed in stub plugin configs,
+    loaded from benchmarks/plugins.
+
+    """
+    config = {
+        'name': 'bench',
+        'bind': '127.0.0.1',
+        'port': port,
+        'plugins_dir': os.path.join(HERE, 'plugins'),
+        'plugins': plugins,
+    }
+    config.update(kwargs)
+    return config
+
+
+def stub_plugin(name, **kwargs):
+    """
+    Returns a stub plugin config, answering a weight from `r['rate']`
+    unless rules are passed in.
+
+    """
+    plugin = {
+        'name': name,
+        'herald_plugin_name': 'bench_stub',
+        'result': {'rate': 3500},
+        'thresholds_metric': "r['rate']",
+        'thresholds': [{'pct': 7000}],
+    }
+    plugin.update(kwargs)
+    return plugin
+
+
+def start_herald(config, engine='gevent', args=()):
+    """
+    Starts herald with the passed in config dict, returns the process once
+    it is accepting connections.
+
+    """
+    fd, path = tempfile.mkstemp(suffix='.yml')
+    with os.fdopen(fd, 'w') as f:
+        yaml.safe_dump(config, f)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'herald.herald', '-c', path, '-e', engine,
+         '-l', 'critical'] + list(args), cwd=ROOT)
+    try:
+        wait_for_port(config['bind'], config['port'])
+    except RuntimeError:
+        process.kill()
+        raise
+    finally:
+        os.unlink(path)
+    return process
+
+
+def stop_herald(process):
+    process.terminate()
+    process.wait()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator emulating haproxy agent checks against a running herald.
+
+Each client opens a connection, optionally writes the agent-send line, and
+reads the response until herald closes the connection. Clients are spread
+over several processes so thousands of concurrent connections can be held
+open.
+
+    $ python benchmarks/loadgen.py -p 5555 -c 2000 -P 4 -d 10 -s 'api77/api\\n'
+
+"""
+
+from __future__ import print_function
+
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import threading
+import multiprocessing
+
+import psutil
+
+
+async def agent_check(host, port, agent_send):
+    """
+    Performs one agent check, returns the response.
+
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if agent_send:
+            writer.write(agent_send)
+        return await reader.read()
+    finally:
+        writer.close()
+
+
+async def client(host, port, agent_send, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            await agent_check(host, port, agent_send)
+        except (OSError, asyncio.IncompleteReadError):
+            errors.append(time.perf_counter())
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_load(host, port, concurrency, duration, agent_send=b''):
+    """
+    Runs `concurrency` clients for `duration` seconds.
+
+    Returns the latency of every successful check, in seconds, and the
+    number of failed checks.
+
+    """
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[client(host, port, agent_send, deadline,
+                                  latencies, errors)
+                           for _ in range(concurrency)])
+    return latencies, len(errors)
+
+
+def raise_nofile_limit():
+    """
+    Raises the open files soft limit to the hard limit, every client holds
+    a file descriptor.
+
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _load_process(args):
+    raise_nofile_limit()
+    return asyncio.run(run_load(*args))
+
+
+def load(host, port, concurrency, duration, agent_send=b'', processes=1):
+    """
+    Runs `concurrency` clients spread over `processes` processes.
+
+    Returns the latencies of all successful checks and the number of failed
+    checks.
+
+    """
+    if processes <= 1:
+        raise_nofile_limit()
+        return asyncio.run(run_load(host, port, concurrency, duration,
+                                    agent_send))
+
+    shares = [concurrency // processes + (i < concurrency % processes)
+              for i in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_load_process,
+                           [(host, port, share, duration, agent_send)
+                            for share in shares if share])
+    finally:
+        pool.close()
+        pool.join()
+    latencies = [l for result in results for l in result[0]]
+    return latencies, sum(result[1] for result in results)
+
+
+class RSSSampler(threading.Thread):
+    """
+    Samples the resident set size of a process every `period` seconds.
+
+    """
+
+    def __init__(self, pid, period=0.5):
+        super(RSSSampler, self).__init__()
+        self.daemon = True
+        self.process = psutil.Process(pid)
+        self.period = period
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = time.time()
+        while not self.stopped.is_set():
+            try:
+                rss = self.process.memory_info().rss
+            except psutil.Error:
+                break
+            self.samples.append((time.time() - start, rss))
+            self.stopped.wait(self.period)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.samples
+
+
+def percentile(sorted_values, q):
+    """
+    Returns the q (0 to 1) percentile of an already sorted list.
+
+    """
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(int(q * len(sorted_values)),
+                             len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors, duration, rss_samples=None):
+    """
+    Returns a dict of checks/sec, latency percentiles in milliseconds and
+    RSS in bytes.
+
+    """
+    latencies = sorted(latencies)
+    summary = {
+        'checks_per_sec': len(latencies) / duration,
+        'errors': errors,
+        'p50_ms': 1000 * percentile(latencies, 0.5),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+        'p999_ms': 1000 * percentile(latencies, 0.999),
+    }
+    if rss_samples:
+        rss = [sample[1] for sample in rss_samples]
+        summary.update({'rss_start': rss[0], 'rss_peak': max(rss),
+                        'rss_end': rss[-1], 'rss_samples': rss_samples})
+    return summary
+
+
+def report(name, summary):
+    line = ('{:<20} {:>10,.0f} checks/sec  p50 {:>7.2f} ms  p99 {:>7.2f} ms'
+            '  p999 {:>7.2f} ms  errors {}'.format(
+                name, summary['checks_per_sec'], summary['p50_ms'],
+                summary['p99_ms'], summary['p999_ms'], summary['errors']))
+    if 'rss_peak' in summary:
+        line += '  rss {:.1f}/{:.1f}/{:.1f} MiB'.format(
+            summary['rss_start'] / 2.0 ** 20, summary['rss_peak'] / 2.0 ** 20,
+            summary['rss_end'] / 2.0 ** 20)
+    print(line)
+
+
+def wait_for_port(host, port, timeout=10):
+    """
+    Waits until something accepts connections on host:port.
+
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('nothing listening on {}:{}'.format(host, port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-H', '--host', default='127.0.0.1', type=str)
+    parser.add_argument('-p', '--port', default=5555, type=int)
+    parser.add_argument('-c', '--concurrency', default=100, type=int,
+                        help='concurrent connections')
+    parser.add_argument('-P', '--processes', default=1, type=int,
+                        help='load generating processes')
+    parser.add_argument('-d', '--duration', default=10, type=float,
+                        help='seconds to run for')
+    parser.add_argument('-s', '--agent-send', default='', type=str,
+                        help='agent-send line, escapes like \\n are expanded')
+    parser.add_argument('--pid', type=int,
+                        help='herald pid, to sample its RSS during the run')
+    args = parser.parse_args()
+
+    agent_send = args.agent_send.encode('UTF-8').decode(
+        'unicode_escape').encode('UTF-8')
+    sampler = None
+    if args.pid:
+        sampler = RSSSampler(args.pid)
+        sampler.start()
+    latencies, errors = load(args.host, args.port, args.concurrency,
+                             args.duration, agent_send, args.processes)
+    rss_samples = sampler.stop() if sampler else None
+    report('{}:{}'.format(args.host, args.port),
+           summarize(latencies, errors, args.duration, rss_samples))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import json
+from herald.baseplugin import HeraldPlugin
+
+
+class StubPlugin(HeraldPlugin):
+    """
+    Benchmark plugin returning the configured `result` after sleeping
+    `delay` seconds, standing in for a health check of that latency.
+
+    With `payload_size` set, every run also decodes a JSON document of about
+    that many bytes, standing in for a CPU heavy health payload.
+
+    """
+
+    herald_plugin_name = 'bench_stub'
+
+    def __init__(self, *args, **kwargs):
+        super(StubPlugin, self).__init__(*args, **kwargs)
+        self.result = kwargs.get('result', {})
+        self.delay = kwargs.get('delay', 0)
+        self.payload = None
+        payload_size = kwargs.get('payload_size', 0)
+        if payload_size:
+            item = {'name': 'backend', 'healthy': True, 'rate': 3500.5}
+            count = payload_size // len(json.dumps(item)) + 1
+            self.payload = json.dumps([item] * count)
+
+    def run(self):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.payload:
+            json.loads(self.payload)
+        return self.result
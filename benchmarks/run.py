@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs the herald benchmark scenarios.
+
+Every scenario starts a herald process with stub plugins, loads it with
+emulated haproxy agent checks and reports checks/sec, latency percentiles
+and herald's RSS over the run. Results can be saved and compared against a
+previous run to catch regressions :
+
+    $ python benchmarks/run.py --save baseline.json
+    $ python benchmarks/run.py --compare baseline.json
+
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+from collections import OrderedDict
+
+from loadgen import load, summarize, report, RSSSampler
+from harness import stub_config, stub_plugin, start_herald, stop_herald
+
+# name: (plugins, top level config, agent-send)
+SCENARIOS = OrderedDict([
+    # run() is called inline on every check
+    ('inline', ([stub_plugin('stub', interval=0)], {}, b'')),
+    # state is polled every second and served from cache
+    ('cached', ([stub_plugin('stub', interval=1)], {}, b'')),
+    # the only poll outlives staleness_interval, staleness_response is served
+    ('stale', ([stub_plugin('stub', interval=1, delay=3600,
+                            staleness_interval=1,
+                            staleness_response='drain')], {}, b'')),
+    # polls take most of the interval, responses must not wait on them
+    ('slow', ([stub_plugin('stub', interval=1, delay=0.9)], {}, b'')),
+    # many plugins in one process, selected with agent-send
+    ('routed', ([stub_plugin('stub{}'.format(i), interval=1)
+                 for i in range(16)], {}, b'bench/stub7\n')),
+])
+
+
+def run_scenario(name, port, args):
+    plugins, extra_config, agent_send = SCENARIOS[name]
+    process = start_herald(stub_config(port, plugins, **extra_config),
+                           args.engine, args.herald_args)
+    try:
+        sampler = RSSSampler(process.pid)
+        sampler.start()
+        latencies, errors = load('127.0.0.1', port, args.concurrency,
+                                 args.duration, agent_send, args.processes)
+        rss_samples = sampler.stop()
+    finally:
+        stop_herald(process)
+    return summarize(latencies, errors, args.duration, rss_samples)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the list of regressions of results against baseline, checks/sec
+    lower or p99 latency higher than `tolerance` (fraction) allows.
+
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['checks_per_sec'] < base['checks_per_sec'] * (1 - tolerance):
+            regressions.append('{}: checks/sec {:.0f} < {:.0f}'.format(
+                name, result['checks_per_sec'], base['checks_per_sec']))
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append('{}: p99 {:.2f} ms > {:.2f} ms'.format(
+                name, result['p99_ms'], base['p99_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run: ' + ', '.join(SCENARIOS))
+    parser.add_argument('-p', '--port', default=15555, type=int)
+    parser.add_argument('-c', '--concurrency', default=1000, type=int,
+                        help='concurrent connections')
+    parser.add_argument('-P', '--processes', default=4, type=int,
+                        help='load generating processes')
+    parser.add_argument('-d', '--duration', default=10, type=float,
+                        help='seconds to run each scenario for')
+    parser.add_argument('-e', '--engine', default='gevent',
+                        choices=['gevent', 'asyncio'])
+    parser.add_argument('--herald-args', default=[], nargs=argparse.REMAINDER,
+                        help='extra herald arguments, e.g. --workers 4')
+    parser.add_argument('--save', type=str, help='save results as json')
+    parser.add_argument('--compare', type=str,
+                        help='json results of a previous run to compare with')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='allowed regression as a fraction')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+
+    results = OrderedDict()
+    for name in args.scenarios or SCENARIOS:
+        results[name] = run_scenario(name, args.port, args)
+        report(name, results[name])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from . import metrics
+from .baseplugin import HeraldPlugin
+from .scheduler import Scheduler
+from .routing import (AGENT_SEND_MAX_SIZE, find_default_plugin,
+                      build_routes, route_request, get_agent_send_timeout)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger('Herald')
+
+# default size of the executor sync plugins are offloaded to
+EXECUTOR_WORKERS = 4
+
+
+class AsyncioScheduler(Scheduler):
+    """
+    Runs all scheduled polls from a single task.
+
+    Each due plugin is polled in a task of its own. Coroutine `run` methods
+    are awaited directly, others are offloaded to `executor`.
+
+    """
+
+    def __init__(self, executor, *args, **kwargs):
+        super(AsyncioScheduler, self).__init__(*args, **kwargs)
+        self.executor = executor
+        self.wakeup = asyncio.Event()
+        self.tasks = {}
+        # the last run of each plugin, which may outlive its poll task
+        self.runs = {}
+        self.watched = {}
+        self.task = None
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.task = asyncio.ensure_future(self.run())
+
+    def add(self, plugin, now=None):
+        super(AsyncioScheduler, self).add(plugin, now)
+        self.wakeup.set()
+
+    def reschedule(self, plugin, now=None):
+        super(AsyncioScheduler, self).reschedule(plugin, now)
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else deadline - time.time()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+            for plugin in self.pop_due():
+                self.fire(plugin)
+
+    def fire(self, plugin):
+        self.tasks[plugin] = asyncio.ensure_future(self.poll(plugin))
+
+    def trigger(self, plugin):
+        """
+        Polls the plugin now, out of its schedule. Can be called from any
+        thread.
+
+        """
+        self.loop.call_soon_threadsafe(self.fire, plugin)
+
+    def watch(self, plugin, fd, callback):
+        """
+        Calls `callback` in the loop whenever `fd` is readable, until the
+        plugin is unwatched.
+
+        """
+        self.loop.add_reader(fd, callback)
+        self.watched[plugin] = fd
+
+    def unwatch(self, plugin):
+        fd = self.watched.pop(plugin, None)
+        if fd is not None:
+            self.loop.remove_reader(fd)
+
+    async def poll(self, plugin):
+        """
+        Polls the plugin like `HeraldPlugin.poll`, bounding the run with its
+        run_timeout.
+
+        A run offloaded to the executor cannot be interrupted, so a timed out
+        run stays marked as running until its thread returns and ticks keep
+        being skipped as overruns until then.
+
+        """
+        if not plugin.begin_run():
+            return
+        started = time.time()
+        if asyncio.iscoroutinefunction(plugin.run):
+            future = asyncio.ensure_future(plugin.run())
+        else:
+            future = self.executor.submit(plugin.execute)
+        run = self.runs[plugin] = asyncio.wrap_future(future)
+
+        def finished(future):
+            plugin.end_run()
+            if not future.cancelled() and future.exception():
+                plugin.logger.critical('Run failed with : %s',
+                                       future.exception())
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(run),
+                                            plugin.run_timeout or None)
+        except asyncio.TimeoutError:
+            plugin.run_timed_out()
+            # executor runs cannot be cancelled, end the run when it returns
+            future.add_done_callback(finished)
+            future.cancel()
+            return
+        except Exception as e:
+            plugin.run_failed(e)
+        else:
+            if metrics.REGISTRY is not None:
+                metrics.REGISTRY.run_seconds.observe(
+                    metrics.plugin_labels(plugin), time.time() - started)
+            try:
+                plugin.update_state(result)
+            except Exception as e:
+                plugin.run_failed(e)
+        plugin.end_run()
+
+    async def join_plugin(self, plugin, timeout):
+        """
+        Unschedules the plugin and waits up to `timeout` seconds for an in
+        progress poll, including a timed out run still in the executor, then
+        cancels it. Returns True if it stopped in time.
+
+        """
+        self.remove(plugin)
+        self.unwatch(plugin)
+        pending = [f for f in (self.tasks.get(plugin), self.runs.get(plugin))
+                   if f is not None and not f.done()]
+        if not pending:
+            return True
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        for future in pending:
+            future.cancel()
+        return not pending
+
+    def stop_plugin(self, plugin, timeout):
+        """
+        Unschedules the plugin, for `HeraldPlugin.stop`. This cannot block
+        the loop, the polls must be awaited with `join_plugin` beforehand.
+        Returns True if no poll is in progress.
+
+        """
+        self.remove(plugin)
+        self.unwatch(plugin)
+        return all(f.done() for f in (self.tasks.get(plugin),
+                                      self.runs.get(plugin))
+                   if f is not None)
+
+    async def stop(self):
+        """
+        Stops scheduling and cancels the polls in progress.
+
+        """
+        tasks = list(self.tasks.values())
+        if self.task is not None:
+            tasks.append(self.task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def handle_scrape(reader, writer):
+    """
+    Answers metric scrapes, see `herald.metrics`.
+
+    """
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                         metrics.REQUEST_TIMEOUT)
+        writer.write(metrics.http_response(request.split(b'\r\n', 1)[0]))
+        await writer.drain()
+    except Exception as e:
+        logger.warning('failed to answer metrics scrape: %s', e)
+    finally:
+        writer.close()
+
+
+class AsyncioServer(object):
+    """
+    Serves the agent protocol with asyncio, without gevent monkey-patching.
+
+    This can be embedded in an application that already runs an asyncio
+    loop :
+
+    >>> server = AsyncioServer(config, plugins)
+    >>> await server.start(('127.0.0.1', 5555))
+    >>> ...
+    >>> await server.stop()
+
+    Plugins with an interval are polled by an `AsyncioScheduler`. Their
+    `run` is awaited directly if it is a coroutine function, otherwise it is
+    offloaded to a bounded thread pool, along with inline (interval 0)
+    plugins and plugins that only implement `respond`.
+
+    """
+
+    def __init__(self, config, plugins, executor_workers=None):
+        self.config = config
+        self.plugins = plugins
+        self.default_plugin = find_default_plugin(config, plugins)
+        self.routes = build_routes(config, plugins)
+        self.agent_send_timeout = get_agent_send_timeout(config, plugins)
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_workers or config.get('executor_workers',
+                                                       EXECUTOR_WORKERS))
+        self.server = None
+        self.metrics_server = None
+        self.scheduler = None
+
+    async def start(self, listen):
+        """
+        Starts polling the plugins and listening for agent checks.
+
+        """
+        self.scheduler = AsyncioScheduler(
+            self.executor, jitter=self.config.get('jitter', 0),
+            spread=self.config.get('schedule_spread', True))
+        self.scheduler.start()
+        for plugin in self.plugins:
+            logger.info('starting %s', plugin.name)
+            plugin.scheduler = self.scheduler
+            plugin.start()
+
+        self.server = await asyncio.start_server(
+            self.handle_requests, listen[0], listen[1])
+        logger.info('started listening %s', listen)
+
+        if self.config.get('metrics_port'):
+            metrics.enable(self.plugins, self.scheduler)
+            metrics_listen = (self.config.get('metrics_bind', listen[0]),
+                              self.config['metrics_port'])
+            self.metrics_server = await asyncio.start_server(
+                handle_scrape, *metrics_listen)
+            logger.info('serving metrics on %s', metrics_listen)
+
+    async def handle_requests(self, reader, writer):
+        """
+        Handles haproxy agent check connections.
+
+        Same as `herald.handle_requests`, responses that are already
+        rendered are written without leaving the loop.
+
+        """
+        registry = metrics.REGISTRY
+        if registry is not None:
+            started = time.time()
+        try:
+            plugin = self.default_plugin
+            if self.agent_send_timeout:
+                try:
+                    agent_send = await asyncio.wait_for(
+                        reader.read(AGENT_SEND_MAX_SIZE),
+                        self.agent_send_timeout)
+                except asyncio.TimeoutError:
+                    agent_send = b''
+                plugin = route_request(self.routes, agent_send,
+                                       self.default_plugin)
+
+            if isinstance(plugin, HeraldPlugin) and plugin.interval:
+                response = plugin.respond_bytes()
+            elif isinstance(plugin, HeraldPlugin) and plugin.run_timeout:
+                # inline run, respond to the last state if it is too slow
+                try:
+                    response = await asyncio.wait_for(
+                        asyncio.shield(asyncio.get_event_loop().run_in_executor(
+                            self.executor, plugin.respond_bytes)),
+                        plugin.run_timeout)
+                except asyncio.TimeoutError:
+                    response = plugin.current_response(rendered=True)
+            else:
+                response = await asyncio.get_event_loop().run_in_executor(
+                    self.executor, plugin.respond_bytes)
+            writer.write(response)
+            await writer.drain()
+            if registry is not None:
+                registry.observe_response(plugin, response,
+                                          time.time() - started)
+        except Exception as e:
+            logger.warning('failed to respond: %s', e)
+        finally:
+            writer.close()
+
+    async def stop(self):
+        """
+        Stops listening, waits for the plugin polls up to their
+        stop_timeout and stops the plugins.
+
+        """
+        if self.server is not None:
+            logger.info('stopping herald server')
+            self.server.close()
+            await self.server.wait_closed()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+
+        # the polls end before the plugins stop, e.g. closing their executor
+        # process
+        polled = [p for p in self.plugins if isinstance(p, HeraldPlugin)]
+        for plugin in polled:
+            plugin.plugin_enabled = False
+        await asyncio.gather(*(self.scheduler.join_plugin(p, p.stop_timeout)
+                               for p in polled))
+        await self.scheduler.stop()
+        for plugin in self.plugins:
+            logger.info('stopping plugin %s', plugin.name)
+            plugin.stop()
+        self.executor.shutdown(wait=False)
+
+
+def serve(listen, config, plugins, snapshot=None):
+    """
+    Runs the asyncio engine until SIGINT or SIGTERM, then saves the state
+    `snapshot` if there is one.
+
+    uvloop is used when installed, unless `uvloop` is disabled in config.
+
+    """
+    if uvloop is not None and config.get('uvloop', True):
+        logger.info('using uvloop')
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    server = AsyncioServer(config, plugins)
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+
+    async def main():
+        await server.start(listen)
+        await stopped.wait()
+        await server.stop()
+        if snapshot is not None:
+            snapshot.save(sync=True)
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
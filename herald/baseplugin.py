@@ -3,15 +3,81 @@
 
 from builtins import str
 from builtins import object
-from gevent import monkey
 from future.utils import with_metaclass
-monkey.patch_all()
 
 import time
 import logging
+import threading
 import gevent
-import sys
-from .rules import HeraldPatterns, HeraldThresholds
+from contextlib import contextmanager
+from gevent import monkey
+from . import metrics
+from . import projection
+from .logs import RATE_LIMITED
+from .rules import HeraldPatterns, HeraldThresholds, metric_key_paths
+from .executors import EXECUTORS, ProcessWorker, ProcessedState
+from .breaker import CircuitBreaker, OPEN, CLOSED
+
+# what to do when a run times out
+OVERRUN_POLICIES = ('skip', 'degrade')
+
+# result keys appended to the state when all present, see `render_state`
+RESULT_SUFFIX_KEYS = (('cpu',), ('mem',), ('net',))
+
+
+class RunTimeout(Exception):
+    """
+    Raised in a plugin run that exceeded its run_timeout.
+
+    """
+
+
+@contextmanager
+def null_deadline():
+    yield
+
+
+def run_deadline(seconds):
+    """
+    Returns a context manager that raises RunTimeout in the current greenlet
+    after `seconds`.
+
+    Only gevent can interrupt a run. Without monkey-patching, like with the
+    asyncio engine, the engine bounds the run instead and this is a no op.
+
+    """
+    if seconds and monkey.is_module_patched('socket'):
+        return gevent.Timeout(seconds, RunTimeout)
+    return null_deadline()
+
+
+class Unchanged(object):
+    """
+    Type of `UNCHANGED`, pickled by reference so it stays a singleton
+    across executor processes.
+
+    """
+
+    def __reduce__(self):
+        return 'UNCHANGED'
+
+    def __repr__(self):
+        return 'UNCHANGED'
+
+
+# returned by a `run` that knows its source did not change since the last
+# run, e.g. on a HTTP 304, the state timestamp is refreshed without
+# processing the rules again
+UNCHANGED = Unchanged()
+
+
+def render_response(value):
+    """
+    Renders a state value into the bytes sent to Haproxy, i.e. the value
+    suffixed with a new line and encoded.
+
+    """
+    return (str(value) + '\n').encode('UTF-8')
 
 
 class PluginMount(type):
@@ -55,9 +121,6 @@ class HeraldBasePlugin(with_metaclass(PluginMount, object)):
         self.state = ''
         self.plugin_enabled = True
         self.logger = logging.getLogger('plugin_'+self.name)
-        if sys.platform == "linux":
-            handler = logging.handlers.SysLogHandler(address='/dev/log')
-            self.logger.addHandler(handler)
 
     def read_state(self):
         return self.state
@@ -71,6 +134,16 @@ class HeraldBasePlugin(with_metaclass(PluginMount, object)):
     def respond(self):
         raise NotImplementedError
 
+    def respond_bytes(self):
+        """
+        Returns the encoded response to send to Haproxy.
+
+        Plugins that keep an already rendered response should override this
+        to avoid rendering on every request.
+
+        """
+        return render_response(self.respond())
+
     def stop(self):
         self.plugin_enabled = False
 
@@ -96,6 +169,9 @@ class HeraldPlugin(HeraldBasePlugin):
 
     The `interval` sets the period for async execution of the `run` method.
     When set to 0 (default) async is disabled, and is instead run inline.
+    Concurrent inline requests share a single `run`, and with
+    `inline_cache_ms` set, requests arriving within that many milliseconds
+    of the last inline run reuse its state.
 
     If `staleness_interval` is not set or set to 0, staleness check is
     disabled, and cached state is returned. The state is marked stale
@@ -107,6 +183,35 @@ class HeraldPlugin(HeraldBasePlugin):
     `stop_timeout` controls the timeout for graceful shutdown. If
     Greenlet does not stop within timeout, it is killed.
 
+    `jitter` delays each scheduled poll by a random 0 - `jitter` seconds,
+    see `herald.scheduler.Scheduler`.
+
+    `run_timeout` bounds every `run`, defaulting to `interval`, 0 disables
+    it. A poll never starts while the previous one is still running, those
+    ticks are counted in `run_overruns`. Timed out runs are counted in
+    `run_timeouts` and the state is kept, then `overrun_policy` decides :
+    'skip' (default) skips the next tick to let the source recover, and
+    'degrade' marks the plugin `degraded` until a run succeeds, responding
+    with `degraded_response` if set.
+
+    With `adaptive_interval` set, the poll period is adapted between
+    `min_interval` and `max_interval` (defaulting to a quarter and four
+    times `interval`). When the threshold metric comes within
+    `adaptive_band` (relative, 0.1 by default) of any threshold, or changes
+    by more than that between polls, the period shortens toward
+    `min_interval`. While it is stable and away from the thresholds the
+    period backs off toward `max_interval`. The current period is kept in
+    `effective_interval`.
+
+    With `breaker` set, a circuit breaker stops polling a failing source,
+    see `herald.breaker.CircuitBreaker` for `breaker_failure_rate`,
+    `breaker_window`, `breaker_min_polls`, `breaker_backoff` (defaulting to
+    twice `interval`, at most `breaker_max_backoff`) and
+    `breaker_max_backoff`. Exceptions, timed out runs
+    and runs returning None or an empty string are failures. While it is
+    open, the state is set to `breaker_response` if set, else the last
+    state is kept until it turns stale.
+
     Threshold and Pattern rules are evaluated against the result.
     Check the docs for the respective class for details on the supported rules.
 
@@ -121,15 +226,91 @@ class HeraldPlugin(HeraldBasePlugin):
     """
     herald_plugin_name = 'herald_plugin'
 
+    # factor the adaptive interval backs off by on every calm poll
+    ADAPTIVE_BACKOFF = 1.5
+
     def __init__(self, *args, **kwargs):
         super(HeraldPlugin, self).__init__(*args, **kwargs)
 
-        self.state = {'timestamp': time.time(), 'value': ''}
+        self.state_listeners = []
+        self.write_state('')
+        # state updates that changed the state, and those that only
+        # refreshed the timestamp
+        self.state_misses = 0
+        self.state_hits = 0
 
         self.interval = kwargs.get('interval', 0)
         assert isinstance(self.interval, int), \
             'interval is not an integer: %s' % self.interval
 
+        self.jitter = kwargs.get('jitter')
+        self.scheduler = None
+
+        self.effective_interval = self.interval
+        self.adaptive_interval = kwargs.get('adaptive_interval', False)
+        self.min_interval = kwargs.get('min_interval', self.interval / 4.0)
+        self.max_interval = kwargs.get('max_interval', self.interval * 4)
+        self.adaptive_band = kwargs.get('adaptive_band', 0.1)
+        if self.adaptive_interval:
+            assert kwargs.get('thresholds'), \
+                'adaptive_interval requires threshold rules'
+            assert 0 < self.min_interval <= self.interval <= self.max_interval, \
+                'interval must be within min_interval {} and max_interval ' \
+                '{}'.format(self.min_interval, self.max_interval)
+        self.last_metric_value = None
+
+        self.run_timeout = kwargs.get('run_timeout', self.interval)
+        assert isinstance(self.run_timeout, (int, float)), \
+            'run_timeout is not a number: {}'.format(self.run_timeout)
+        self.overrun_policy = kwargs.get('overrun_policy', 'skip')
+        assert self.overrun_policy in OVERRUN_POLICIES, \
+            'overrun_policy must be one of {}: {}'.format(
+                ', '.join(OVERRUN_POLICIES), self.overrun_policy)
+        self.degraded_response = kwargs.get('degraded_response', '')
+        self.rendered_degraded_response = render_response(
+            self.degraded_response)
+        self.running = False
+        # the AsyncResult of a run in the thread executor, see `poll`
+        self.thread_run = None
+        self.degraded = False
+        self.skip_next_tick = False
+        # whether the last result was written to the state, see `update_state`
+        self.last_run_ok = True
+        self.run_timeouts = 0
+        self.run_overruns = 0
+
+        self.executor = kwargs.get('executor')
+        assert self.executor in EXECUTORS + (None,), \
+            'executor must be one of {}: {}'.format(', '.join(EXECUTORS),
+                                                    self.executor)
+        self.worker = None
+        if self.executor == 'process':
+            self.worker = ProcessWorker(type(self), dict(kwargs, name=self.name),
+                                        kwargs.get('executor_rules', False))
+
+        self.breaker = None
+        if kwargs.get('breaker', False):
+            max_backoff = kwargs.get('breaker_max_backoff', 300)
+            self.breaker = CircuitBreaker(
+                failure_rate=kwargs.get('breaker_failure_rate', 0.5),
+                window=kwargs.get('breaker_window', 10),
+                min_polls=kwargs.get('breaker_min_polls', 5),
+                backoff=kwargs.get('breaker_backoff',
+                                   min(max(self.interval, 1) * 2,
+                                       max_backoff)),
+                max_backoff=max_backoff)
+        # None keeps the last state while the breaker is open
+        self.breaker_response = kwargs.get('breaker_response')
+        if self.breaker_response == 'noop':
+            self.breaker_response = ''
+
+        self.inline_cache_ms = kwargs.get('inline_cache_ms', 0)
+        assert isinstance(self.inline_cache_ms, (int, float)), \
+            'inline_cache_ms is not a number: {}'.format(self.inline_cache_ms)
+        self.inline_lock = threading.Lock()
+        self.inline_poll_done = None
+        self.inline_polled_at = 0
+
         self.staleness_interval = kwargs.get('staleness_interval', 0)
         assert isinstance(self.staleness_interval, int), \
             'staleness_interval is not an integer: {}'.format(
@@ -143,6 +324,8 @@ class HeraldPlugin(HeraldBasePlugin):
         self.staleness_response = kwargs.get('staleness_response', '')
         if self.staleness_response == 'noop':
             self.staleness_response = ''
+        self.rendered_staleness_response = render_response(
+            self.staleness_response)
 
         threshold_rules = kwargs.get('thresholds', [])
         pattern_rules = kwargs.get('patterns', [])
@@ -158,6 +341,17 @@ class HeraldPlugin(HeraldBasePlugin):
             pattern_metric = kwargs.get('patterns_metric', 'r')
             self.hp = HeraldPatterns(pattern_rules, pattern_metric)
 
+        # JSON results are parsed down to the keys the metrics read, unless
+        # json_projection is off or a metric reads the whole result
+        self.json_projection = None
+        if kwargs.get('json_projection', True):
+            metric_paths = [metric_key_paths(r.metric) for r in
+                            (getattr(self, 'ht', None),
+                             getattr(self, 'hp', None)) if r is not None]
+            if None not in metric_paths:
+                self.json_projection = projection.Projection(
+                    set(RESULT_SUFFIX_KEYS).union(*metric_paths))
+
         self.default_response = kwargs.get('default_response', '')
         if self.default_response == 'noop':
             self.default_response = ''
@@ -166,14 +360,19 @@ class HeraldPlugin(HeraldBasePlugin):
         """
         Starts run with the specified interval.
 
-        If interval is 0 its a no op.
+        The polls are scheduled with `scheduler` if the engine set one before
+        starting the plugin, else they run in a gevent loop of their own. If
+        interval is 0 its a no op.
 
         """
         if not self.interval == 0:
             self.logger.debug(
-                "running plugin {} with interval {} seconds".format(
-                    self.name, self.interval))
-            self.g = gevent.spawn(self.run_with_interval)
+                'running plugin %s with interval %s seconds',
+                self.name, self.interval)
+            if self.scheduler is not None:
+                self.scheduler.add(self)
+            else:
+                self.g = gevent.spawn(self.run_with_interval)
 
     def read_state(self):
         """
@@ -186,32 +385,303 @@ class HeraldPlugin(HeraldBasePlugin):
         """
         Write value to state along with the timestamp for staleness detection.
 
+        The state is replaced as a whole, together with the rendered response
+        so requests never see a value and response that do not match.
+
+        """
+        self.state = {'timestamp': time.time(),
+                      'value': value,
+                      'response': render_response(value)}
+        self.notify_state_listeners()
+
+    def touch_state(self):
         """
-        self.state['value'] = value
-        self.state['timestamp'] = time.time()
+        Refresh the state timestamp, keeping the value and rendered response.
+
+        """
+        self.state = dict(self.state, timestamp=time.time())
+        self.notify_state_listeners()
+
+    def add_state_listener(self, listener):
+        """
+        Register `listener` to be called with the plugin on every state write
+        or timestamp refresh, and when the plugin turns degraded.
+
+        """
+        self.state_listeners.append(listener)
+
+    def notify_state_listeners(self):
+        for listener in self.state_listeners:
+            listener(self)
 
     def run_with_interval(self):
         """
-        Helper to run the `run` function in a gevent loop.
+        Helper to run the `run` function in a gevent loop, at a fixed rate.
 
         """
+        deadline = time.time()
         while self.plugin_enabled:
-            try:
-                result = self.run()
-                state = self.process_rules(result)
-                if state:
-                    if 'cpu' in result and 'mem' in result and 'net' in result:
-                        state += ' # {:.2f} {:.2f} {}'.format(result['cpu'],
-                                                              result['net'],
-                                                              result['mem'])
-                    self.write_state(state)
-                # if no state means none of the rules matched
-                else:
-                    self.write_state(self.default_response)
-            except Exception as e:
-                self.logger.critical('Run failed with : %s' % e)
-
-            gevent.sleep(self.interval)
+            self.poll()
+            deadline += self.effective_interval
+            gevent.sleep(max(deadline - time.time(), 0))
+
+    def poll(self):
+        """
+        Runs `run` once, bounded by `run_timeout`, and updates the state with
+        the result. Nothing is run if the previous poll is still running.
+
+        A timed out run in the thread executor is handled as described in
+        `herald.aioserver.AsyncioScheduler.poll`.
+
+        """
+        if not self.begin_run():
+            return
+        try:
+            started = time.time()
+            with run_deadline(self.run_timeout):
+                result = self.execute()
+            if metrics.REGISTRY is not None:
+                metrics.REGISTRY.run_seconds.observe(
+                    metrics.plugin_labels(self), time.time() - started)
+            self.update_state(result)
+        except RunTimeout:
+            self.run_timed_out()
+        except Exception as e:
+            self.run_failed(e)
+        finally:
+            thread_run, self.thread_run = self.thread_run, None
+            if thread_run is not None and not thread_run.ready():
+                # end the run when its thread returns
+                thread_run.rawlink(lambda _: self.end_run())
+            else:
+                self.end_run()
+
+    def execute(self):
+        """
+        Runs `run` in the plugin's executor and returns its result.
+
+        The thread executor only applies under gevent, the asyncio engine
+        already runs it in a thread.
+
+        """
+        if self.worker is not None:
+            return self.worker.call(self.last_run_ok)
+        if self.executor == 'thread' and monkey.is_module_patched('socket'):
+            self.thread_run = gevent.get_hub().threadpool.spawn(self.run)
+            return self.thread_run.get()
+        return self.run()
+
+    def begin_run(self):
+        """
+        Marks a run as started, returns False if it should not run because
+        the previous run is still going (an overrun) or the tick is skipped.
+
+        """
+        if self.running:
+            self.run_overruns += 1
+            self.logger.warning('previous run still in progress, skipping '
+                                'this tick', extra=RATE_LIMITED)
+            return False
+        if self.skip_next_tick:
+            self.skip_next_tick = False
+            return False
+        if self.breaker is not None and not self.breaker.allow():
+            if self.breaker_response is not None:
+                # keep serving breaker_response rather than turning stale
+                self.touch_state()
+            return False
+        self.running = True
+        return True
+
+    def end_run(self):
+        self.running = False
+
+    def run_timed_out(self):
+        """
+        Applies the overrun policy to a run that exceeded `run_timeout`.
+
+        """
+        self.run_timeouts += 1
+        self.logger.warning('run did not finish within run_timeout %ss, '
+                            'keeping the last state', self.run_timeout,
+                            extra=RATE_LIMITED)
+        if self.overrun_policy == 'skip':
+            self.skip_next_tick = True
+        elif not self.degraded:
+            self.degraded = True
+            self.notify_state_listeners()
+        self.record_run(False)
+
+    def run_failed(self, e):
+        self.logger.critical('Run failed with : %s', e)
+        self.last_run_ok = False
+        self.record_run(False)
+
+    def record_run(self, success):
+        """
+        Records the outcome of a poll in the circuit breaker, if any, and
+        writes `breaker_response` when it opens.
+
+        """
+        if self.breaker is None:
+            return
+        state = self.breaker.record(success)
+        if state == OPEN:
+            self.logger.warning('circuit breaker open, polling again in '
+                                '%.1fs', self.breaker.delay)
+            if self.breaker_response is not None:
+                self.write_state(self.breaker_response)
+        elif state == CLOSED:
+            self.logger.info('circuit breaker closed')
+
+    def poll_inline(self):
+        """
+        Polls for an inline (interval 0) request.
+
+        Concurrent calls are coalesced onto a single in flight `poll`, the
+        other callers wait for it and respond with the state it wrote. If
+        `inline_cache_ms` is set and the last poll is more recent, nothing
+        is run.
+
+        """
+        if (self.inline_cache_ms and
+                (time.time() - self.inline_polled_at) * 1000 <
+                self.inline_cache_ms):
+            return
+
+        with self.inline_lock:
+            done = self.inline_poll_done
+            in_flight = done is not None
+            if not in_flight:
+                done = self.inline_poll_done = threading.Event()
+
+        if in_flight:
+            done.wait()
+            return
+
+        try:
+            self.poll()
+            self.inline_polled_at = time.time()
+        finally:
+            with self.inline_lock:
+                self.inline_poll_done = None
+            done.set()
+
+    def render_state(self, result):
+        """
+        Process the rules against the `run` result and returns the state.
+
+        """
+        started = time.time()
+        state = self.process_rules(result)
+        if metrics.REGISTRY is not None:
+            metrics.REGISTRY.rules_seconds.observe(
+                metrics.plugin_labels(self), time.time() - started)
+        if state:
+            if 'cpu' in result and 'mem' in result and 'net' in result:
+                state += ' # {:.2f} {:.2f} {}'.format(result['cpu'],
+                                                      result['net'],
+                                                      result['mem'])
+        # if no state means none of the rules matched
+        else:
+            state = self.default_response
+        return state
+
+    def update_state(self, result):
+        """
+        Process the rules against the `run` result and write the state.
+
+        If the state is unchanged only its timestamp is refreshed, nothing is
+        rendered again. A `run` returning UNCHANGED refreshes the timestamp
+        without processing the rules.
+
+        """
+        if result is UNCHANGED:
+            if not self.last_run_ok:
+                # unchanged since a result that failed, the state stays as
+                # old as the last good one
+                self.record_run(False)
+                return
+            self.degraded = False
+            self.state_hits += 1
+            self.touch_state()
+            self.record_run(True)
+            return
+
+        if self.breaker is not None and (result is None or result == ''):
+            # a failed run, the breaker decides what to respond with
+            self.last_run_ok = False
+            self.record_run(False)
+            return
+
+        if isinstance(result, ProcessedState):
+            # the rules were processed by the executor process
+            state = result.state
+            if hasattr(self, 'ht'):
+                self.ht.last_value = result.metric_value
+        else:
+            state = self.render_state(result)
+
+        self.degraded = False
+        if self.adaptive_interval:
+            self.adapt_interval()
+
+        if state == self.state['value']:
+            self.state_hits += 1
+            self.touch_state()
+        else:
+            self.state_misses += 1
+            self.write_state(state)
+        self.last_run_ok = True
+        self.run_succeeded()
+        self.record_run(True)
+
+    def run_succeeded(self):
+        """
+        Called once the result of a run was written to the state. Plugins
+        that return UNCHANGED keep what they compare the source against from
+        here on, so a result the rules failed on is read again.
+
+        """
+
+    def adapt_interval(self):
+        """
+        Adapts `effective_interval` to how close the last threshold metric
+        value is to the thresholds and how fast it changes.
+
+        """
+        try:
+            value = float(self.ht.last_value)
+        except (TypeError, ValueError):
+            return
+
+        # relative distance to the closest threshold, and relative change
+        # since the last poll, 0 meaning at a threshold or not changing
+        distance = min(abs(value - rule.threshold) / max(abs(rule.threshold), 1)
+                       for rule in self.ht._parsed_rules)
+        change = 0
+        if self.last_metric_value is not None:
+            change = (abs(value - self.last_metric_value) /
+                      max(abs(self.last_metric_value), 1))
+        self.last_metric_value = value
+
+        calm = min(distance / self.adaptive_band,
+                   1 - change / self.adaptive_band)
+        previous = self.effective_interval
+        if calm < 1:
+            calm = max(calm, 0)
+            self.effective_interval = min(
+                previous,
+                self.min_interval + (self.interval - self.min_interval) * calm)
+        else:
+            self.effective_interval = min(previous * self.ADAPTIVE_BACKOFF,
+                                          self.max_interval)
+
+        if self.effective_interval != previous:
+            self.logger.debug('effective interval %.2fs',
+                              self.effective_interval)
+            if self.effective_interval < previous and self.scheduler:
+                self.scheduler.reschedule(self)
 
     def process_rules(self, result):
         """
@@ -245,6 +715,16 @@ class HeraldPlugin(HeraldBasePlugin):
             state.append('100%')
         return ' '.join(state)
 
+    def loads_json(self, text):
+        """
+        Parses a JSON result, only decoding the keys the rule metrics read
+        when they are known, see `projection`.
+
+        """
+        if self.json_projection is not None:
+            return self.json_projection.loads(text)
+        return projection.loads(text)
+
     def run(self):
         """
         This should do the actual work and return the result.
@@ -267,29 +747,64 @@ class HeraldPlugin(HeraldBasePlugin):
         """
         Respond with the final value to send to Haproxy.
 
-        If interval is 0, we need to run the `run` method inline.
-        Check for staleness and respond accordingly.
+        If interval is 0, we need to poll inline, see `poll_inline`.
+        Check for staleness and respond accordingly, see `current_response`.
 
         """
         if self.interval == 0:
-            self.run()
+            self.poll_inline()
+        return self.current_response()
+
+    def respond_bytes(self):
+        """
+        Same as `respond`, but returns the pre-rendered response bytes.
 
+        This is what the agent check handler sends, nothing is formatted or
+        encoded per request.
+
+        """
+        if self.interval == 0:
+            self.poll_inline()
+        return self.current_response(rendered=True)
+
+    def current_response(self, rendered=False):
+        """
+        Returns the response to the current state without polling : the
+        staleness response if it is stale, the degraded response if degraded
+        and set, else the state. With `rendered` the pre-rendered bytes are
+        returned.
+
+        """
         if self.is_stale():
-            self.logger.warning('detected stale state, staleness_interval'
-                                ' is set to {}s'.format(self.staleness_interval))
+            self.log_stale()
+            if rendered:
+                return self.rendered_staleness_response
+            return self.staleness_response
+        elif self.degraded and self.degraded_response:
+            if rendered:
+                return self.rendered_degraded_response
+            return self.degraded_response
+        elif rendered:
+            return self.state['response']
+        else:
+            return self.read_state()
 
-            if self.staleness_response and self.staleness_response != 'noop':
-                self.logger.warning('responding with staleness_response :'
-                                    ' {}'.format(self.staleness_response))
-                return self.staleness_response
-            else:
-                self.logger.warning('staleness_response is not set or set to'
-                                    ' "noop", responding with empty string :'
-                                    ' {}'.format(self.staleness_response))
-                return ''
+    def log_stale(self):
+        """
+        Log that the state is stale and what is being responded with.
+
+        """
+        self.logger.warning('detected stale state, staleness_interval is '
+                            'set to %ss', self.staleness_interval,
+                            extra=RATE_LIMITED)
+
+        if self.staleness_response:
+            self.logger.warning('responding with staleness_response : %s',
+                                self.staleness_response, extra=RATE_LIMITED)
         else:
-            state = self.read_state()
-            return state
+            self.logger.warning('staleness_response is not set or set to '
+                                '"noop", responding with empty string : %s',
+                                self.staleness_response, extra=RATE_LIMITED)
 
     def stop(self):
         """
@@ -306,7 +821,15 @@ class HeraldPlugin(HeraldBasePlugin):
 # It'll help parallelise things
         # no action required if not async
         if self.interval == 0:
-            return
+            pass
+        elif self.scheduler is not None:
+            self.plugin_enabled = False
+            if self.scheduler.stop_plugin(self, self.stop_timeout):
+                self.logger.info('stopped')
+            else:
+                self.logger.warning('could not stop within stop_timeout %s, '
+                                    'terminating with kill',
+                                    self.stop_timeout)
         else:
             self.plugin_enabled = False
             try:
@@ -315,12 +838,15 @@ class HeraldPlugin(HeraldBasePlugin):
                 self.g.join()
                 self.logger.info('stopped')
             except gevent.Timeout:
-                self.logger.warning('could not stop within stop_timeout {}, '
-                                    'terminating with kill'.format(
-                                     self.stop_timeout))
+                self.logger.warning('could not stop within stop_timeout %s, '
+                                    'terminating with kill',
+                                    self.stop_timeout)
                 self.g.kill()
             finally:
                 t.cancel()
+        # closed once no poll is using it
+        if self.worker is not None:
+            self.worker.close()
 
 
 class ExamplePlugin(HeraldBasePlugin):
@@ -338,4 +864,4 @@ class ExamplePlugin(HeraldBasePlugin):
         return self.read_state()
 
     def stop(self):
-        self.logger.info("stopping plugin {}".format(self.name))
+        self.logger.info('stopping plugin %s', self.name)
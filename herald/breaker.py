@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker over the outcomes of the polls of a plugin, so a failing
+    source is left alone instead of being polled every interval.
+
+    While closed the outcomes of the last `window` polls are kept. Once at
+    least `min_polls` were recorded and the share of failures reaches
+    `failure_rate`, the breaker opens and refuses polls for a backoff. The
+    backoff starts at `backoff` seconds and doubles on every consecutive
+    opening up to `max_backoff`, with equal jitter (between half and the
+    whole of it) so plugins failing together do not retry together.
+
+    After the backoff the breaker is half-open and lets one trial poll
+    through. It closes if that poll succeeds, else opens again.
+
+    """
+
+    def __init__(self, failure_rate=0.5, window=10, min_polls=5, backoff=10,
+                 max_backoff=300):
+        assert 0 < failure_rate <= 1, \
+            'breaker_failure_rate must be within 0 and 1: {}'.format(
+                failure_rate)
+        assert isinstance(window, int) and window > 0, \
+            'breaker_window is not a positive integer: {}'.format(window)
+        assert 0 < min_polls <= window, \
+            'breaker_min_polls must be within 1 and breaker_window: ' \
+            '{}'.format(min_polls)
+        assert 0 < backoff <= max_backoff, \
+            'breaker_backoff must be within 0 and breaker_max_backoff: ' \
+            '{}'.format(backoff)
+        self.failure_rate = failure_rate
+        self.min_polls = min_polls
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        # consecutive openings, the exponent of the backoff
+        self.openings = 0
+        self.delay = 0
+        self.open_until = 0
+        self.trips = 0
+
+    def allow(self, now=None):
+        """
+        Returns whether a poll may run now, turning half-open once the
+        backoff is over.
+
+        """
+        if self.state == OPEN:
+            if (now or time.time()) < self.open_until:
+                return False
+            self.state = HALF_OPEN
+        return True
+
+    def record(self, success, now=None):
+        """
+        Records the outcome of a poll. Returns the new state if it changed,
+        else None.
+
+        """
+        if self.state == HALF_OPEN:
+            if success:
+                self.close()
+                return CLOSED
+            self.open(now)
+            return OPEN
+        elif self.state == OPEN:
+            # a poll started before the breaker opened
+            return None
+
+        self.outcomes.append(success)
+        failures = len(self.outcomes) - sum(self.outcomes)
+        if (len(self.outcomes) >= self.min_polls and
+                failures >= self.failure_rate * len(self.outcomes)):
+            self.open(now)
+            return OPEN
+        return None
+
+    def open(self, now=None):
+        delay = min(self.backoff * 2 ** self.openings, self.max_backoff)
+        if delay < self.max_backoff:
+            self.openings += 1
+        self.delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        self.open_until = (now or time.time()) + self.delay
+        self.state = OPEN
+        self.trips += 1
+
+    def close(self):
+        self.state = CLOSED
+        self.openings = 0
+        self.outcomes.clear()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Executors running plugin `run` methods off the gevent hub.
+
+With `executor: process` a plugin runs in a worker process of its own, so
+CPU heavy runs (e.g. decoding large JSON payloads) do not hold the GIL of
+the process answering agent checks. The worker is `python -m
+herald.executors`, it instantiates the plugin from its class and config and
+runs it on request, exchanging pickled frames over its stdin and stdout.
+
+"""
+
+import os
+import sys
+import pickle
+import signal
+import struct
+import logging
+import importlib
+import threading
+import subprocess
+from collections import namedtuple
+
+logger = logging.getLogger('Herald')
+
+EXECUTORS = ('thread', 'process')
+
+# length prefix of the pickled frames
+FRAME_HEADER = struct.Struct('=I')
+
+# result of a run with the rules already processed in the worker, along
+# with the threshold metric value the adaptive interval needs
+ProcessedState = namedtuple('ProcessedState', 'state metric_value')
+
+
+def write_frame(f, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(FRAME_HEADER.pack(len(data)) + data)
+    f.flush()
+
+
+def read_exactly(f, size):
+    data = b''
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            raise EOFError('executor process exited')
+        data += chunk
+    return data
+
+
+def read_frame(f):
+    size, = FRAME_HEADER.unpack(read_exactly(f, FRAME_HEADER.size))
+    return pickle.loads(read_exactly(f, size))
+
+
+class ProcessWorker(object):
+    """
+    Runs a plugin in a worker process, started on the first call.
+
+    `plugin_class` is instantiated in the worker with `config`. If `rules` is
+    set the worker also processes the plugin rules and a call returns a
+    `ProcessedState` instead of the `run` result.
+
+    Calls are serialized. If a call is interrupted, e.g. by the run_timeout,
+    the worker is killed and a new one started on the next call.
+
+    """
+
+    def __init__(self, plugin_class, config, rules=False):
+        module = sys.modules[plugin_class.__module__]
+        config = dict(config, executor=None)
+        self.spec = (plugin_class.__module__, getattr(module, '__file__', None),
+                     plugin_class.__name__, config, rules)
+        self.name = config.get('name')
+        self.lock = threading.Lock()
+        self.process = None
+
+    def start(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'herald.executors'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+            close_fds=True)
+        write_frame(self.process.stdin, self.spec)
+        logger.debug('started executor process %s for %s',
+                     self.process.pid, self.name)
+
+    def call(self, succeeded=False):
+        """
+        Runs the plugin in the worker and returns the result, raising an
+        Exception if the run failed.
+
+        `succeeded` tells the worker the result of the previous call was
+        written to the state, see `HeraldPlugin.run_succeeded`.
+
+        """
+        with self.lock:
+            if self.process is None:
+                self.start()
+            try:
+                write_frame(self.process.stdin, succeeded)
+                ok, result = read_frame(self.process.stdout)
+            except BaseException:
+                self.close()
+                raise
+        if not ok:
+            raise Exception(result)
+        return result
+
+    def close(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        process.kill()
+        process.wait()
+        process.stdin.close()
+        process.stdout.close()
+
+
+def load_plugin_class(module_name, path, class_name):
+    from .registry import load_source
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        module = load_source(module_name, path)
+    return getattr(module, class_name)
+
+
+def worker_main():
+    """
+    Executor process loop, runs the plugin for every request frame until
+    stdin is closed. A request frame is set once the parent wrote the
+    previous result to the state.
+
+    """
+    from .baseplugin import UNCHANGED
+    # the parent handles interrupts and closes stdin to stop the worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stdin = os.fdopen(os.dup(0), 'rb')
+    stdout = os.fdopen(os.dup(1), 'wb')
+    # anything the plugin prints must not corrupt the frames
+    os.dup2(2, 1)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s [%(name)s] '
+                               '%(message)s')
+    module_name, path, class_name, config, rules = read_frame(stdin)
+    plugin = load_plugin_class(module_name, path, class_name)(**config)
+
+    while True:
+        try:
+            succeeded = read_frame(stdin)
+        except EOFError:
+            break
+        try:
+            if succeeded:
+                plugin.run_succeeded()
+            result = plugin.run()
+            # failed runs are left to the parent, e.g. for its breaker
+            if rules and result not in (UNCHANGED, None, ''):
+                ht = getattr(plugin, 'ht', None)
+                result = ProcessedState(plugin.render_state(result),
+                                        ht.last_value if ht else None)
+            response = (True, result)
+        except Exception as e:
+            response = (False, 'Run failed in executor : {}'.format(e))
+        write_frame(stdout, response)
+
+
+if __name__ == '__main__':
+    # run from the herald.executors module so the frames pickle its classes
+    # and not __main__'s
+    from herald.executors import worker_main
+    worker_main()
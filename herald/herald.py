@@ -3,18 +3,26 @@
 
 from builtins import str
 from gevent import monkey
-monkey.patch_all()
 
-import os
 import sys
-import imp
 import signal
 import yaml
+import logging
 import argparse
+import time
 import gevent
 from functools import partial
+from socket import timeout as sockettimeout
 from gevent.server import StreamServer
-from .baseplugin import HeraldBasePlugin
+from .registry import PluginRegistry
+from .workers import WorkerPool, share_plugins
+from .shm import StateSegment
+from .scheduler import GeventScheduler
+from .snapshot import load_snapshot
+from . import metrics
+from .logs import setup_pipeline
+from .routing import (AGENT_SEND_MAX_SIZE, find_default_plugin,
+                      build_routes, route_request, get_agent_send_timeout)
 
 # TODO: Add tests
 #       option to use syslog for logging
@@ -23,121 +31,95 @@ from .baseplugin import HeraldBasePlugin
 logger = None
 
 
-def start_plugin(plugin):
+def start_plugin(plugin, scheduler):
     """
-    Starts the passed in plugin.
+    Starts the passed in plugin, with its polls scheduled by scheduler.
+
+    The scheduler is set on the plugin rather than passed to `start`, so
+    plugins overriding `start(self)` keep working.
 
     """
     global logger
-    logger.info("starting {}".format(plugin.name))
+    logger.info('starting %s', plugin.name)
+    plugin.scheduler = scheduler
     plugin.start()
 
 
-def load_all_plugins(plugins_dir):
+def load_plugins(registry, plugins_config):
     """
-    Loads all plugins found in the plugins_dir directory.
-
-    The HeraldBasePlugin class is the "plugin mount" class that
-    has a list of all the plugin classes loaded.
-
-    Returns a dict with the plugin name as the key and the reference
-    to the respective class as the value.
+    Instantiates the plugins in plugins_config, importing only the plugin
+    classes they use from the registry.
 
     """
     global logger
-    for fn in os.listdir(plugins_dir):
-        if fn.endswith('.py'):
-            name = os.path.basename(fn)[:-3]
-            try:
-                imp.load_source(name, os.path.join(plugins_dir, fn))
-            except Exception as e:
-                logger.critical('Error loading plugin {}: {} '.format(name, e))
-                sys.exit()
-
-    all_plugins = dict()
-    for p in HeraldBasePlugin.plugins:
-        all_plugins[p.herald_plugin_name] = p
-
-    logger.info(all_plugins)
-    return all_plugins
-
+    plugins = []
+    for plugin_config in plugins_config:
+        plugin_name = plugin_config['herald_plugin_name']
+        try:
+            PluginClass = registry.load(plugin_name)
+        except Exception as e:
+            logger.critical('Could not load plugin %s: %s', plugin_name, e)
+            sys.exit()
 
-def load_plugin(plugins_list, plugins_config):
-    """
-    Finds the default plugin, initilizes it and returns the plugin object.
-
-    Plugins are checked for the 'default' key or the first one in the list
-    is used.
-    Plugin is initialized by passing the entire plugin definition dict found
-    in plugins_config.
-
-    """
-    global logger
-    # check for 'default' flag
-    default_plugin = [p for p in plugins_config if 'default' in p]
-    # else take the first one in the list
-    if not default_plugin:
-        default_plugin = plugins_config[0]
-    logger.debug('using plugin {}'.format(default_plugin['herald_plugin_name']))
+        logger.debug('using plugin %s for %s',
+                     plugin_name, plugin_config['name'])
+        plugins.append(PluginClass(**plugin_config))
 
-    try:
-        PluginClass = plugins_list.get(default_plugin['herald_plugin_name'])
-    except KeyError:
-        logger.critical('Could not load plugin {}'.format(
-            default_plugin['herald_plugin_name']))
-        sys.exit()
+    return plugins
 
-    p = PluginClass(**default_plugin)
-    return p
 
 HERALD_STOPPING = False
 
 
-def stop_services(server, plugin):
+def stop_services(server, scheduler, plugins, snapshot=None,
+                  metrics_server=None):
     """
-    Stop plugin and server gracefully.
+    Stop plugins, scheduler and servers gracefully, saving the state
+    snapshot last.
 
     """
     global HERALD_STOPPING
     global logger
     if not HERALD_STOPPING:
         HERALD_STOPPING = True
-        logger.info('stopping plugin {}'.format(plugin.name))
-        plugin.stop()
+        for plugin in plugins:
+            logger.info('stopping plugin %s', plugin.name)
+            plugin.stop()
+        scheduler.stop()
         logger.info('stopping herald server')
         server.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if snapshot is not None:
+            snapshot.save(sync=True)
     else:
         logger.info('stop is already in progress')
 
 
-def setup_handlers(server, plugin):
+def setup_handlers(server, scheduler, plugins, snapshot=None,
+                   metrics_server=None):
     """
     Setup signal handlers to stop server gracefully.
 
     """
-    gevent.signal(signal.SIGINT, partial(stop_services, server, plugin))
-    gevent.signal(signal.SIGTERM, partial(stop_services, server, plugin))
+    stop = partial(stop_services, server, scheduler, plugins, snapshot,
+                   metrics_server)
+    # gevent.signal was renamed to gevent.signal_handler in gevent 1.5
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGINT, stop)
+    signal_handler(signal.SIGTERM, stop)
 
 
 def setup_logging(args):
     """
-    Initialize logger with the requested Loglevel, and the specified
-    logformat.
+    Initialize logger with the requested Loglevel, logging to stderr and
+    syslog through the non-blocking pipeline, see `herald.logs`.
 
     """
     global logger
-    import logging
-    loglevel = args.loglevel.upper()
-    logformat = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
-
-    logging.basicConfig(format=logformat, level=loglevel)
+    setup_pipeline(args.loglevel.upper())
     logger = logging.getLogger('Herald')
 
-    if sys.platform == "linux":
-        import logging.handlers
-        handler = logging.handlers.SysLogHandler(address='/dev/log')
-        logger.addHandler(handler)
-
 
 def load_configuration(config_file):
     """
@@ -146,44 +128,122 @@ def load_configuration(config_file):
     """
     global logger
     with open(config_file) as config_fd:
-        config = yaml.load(config_fd)
+        config = yaml.safe_load(config_fd)
 
-    logger.debug('config is {}'.format(config))
+    logger.debug('config is %s', config)
     return config
 
 
-def handle_requests(socket, addr, plugin):
+def read_agent_send(socket, timeout):
+    """
+    Reads the agent-send line sent by haproxy, waiting at most `timeout`
+    seconds. Returns an empty string if nothing was sent in time.
+
+    """
+    socket.settimeout(timeout)
+    try:
+        return socket.recv(AGENT_SEND_MAX_SIZE)
+    except (sockettimeout, OSError):
+        return b''
+
+
+def handle_requests(socket, addr, routes, default_plugin, agent_send_timeout):
     """
     Handles haproxy agent check connections
 
-    The state to write is obtained from the passed in plugin
-    using the `respond` function. The state is suffixed with
-    a new line and sent to Haproxy.
+    The agent-send line, if any, selects the plugin from `routes`, falling
+    back to `default_plugin`. The state to write is obtained from the
+    plugin using the `respond` function. The state is suffixed with a new
+    line and sent to Haproxy.
+
+    """
+    global logger
+    registry = metrics.REGISTRY
+    if registry is not None:
+        started = time.time()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('received connect from %s', addr)
+    if agent_send_timeout:
+        agent_send = read_agent_send(socket, agent_send_timeout)
+        plugin = route_request(routes, agent_send, default_plugin)
+    else:
+        plugin = default_plugin
+    response = plugin.respond_bytes()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('writing state: %r', response)
+    socket.sendall(response)
+    if registry is not None:
+        registry.observe_response(plugin, response, time.time() - started)
+
+
+def make_handler(config, plugins):
+    """
+    Returns the agent check connection handler, with the routing table for
+    the passed in plugins bound to it.
 
     """
     global logger
-    logger.debug("received connect from {}".format(addr))
-    state = plugin.respond()
-    logger.debug("writing state: {}".format(state))
-    socket.send((str(state)+"\n").encode('UTF-8'))
+    default_plugin = find_default_plugin(config, plugins)
+    routes = build_routes(config, plugins)
+    agent_send_timeout = get_agent_send_timeout(config, plugins)
+    logger.info('default plugin is %s', default_plugin.name)
+
+    return partial(handle_requests, routes=routes,
+                   default_plugin=default_plugin,
+                   agent_send_timeout=agent_send_timeout)
 
 
-def start_server(args, config, plugin):
+def get_listen(args, config):
+    return (config.get('bind', args.bind), config.get('port', args.port))
+
+
+def start_server(args, config, plugins):
     """
     Starts the main listener for haporxy agent requests with the handler
     function.
 
     """
     global logger
-    listen = (config.get('bind', args.bind), config.get('port', args.port))
-    handler = partial(handle_requests, plugin=plugin)
-    server = StreamServer(listen, handler)
+    listen = get_listen(args, config)
+    server = StreamServer(listen, make_handler(config, plugins))
 
-    logger.info("started listening {}".format(listen))
+    logger.info('started listening %s', listen)
     server.start()
     return server
 
 
+def start_workers(args, config, plugins, workers):
+    """
+    Forks `workers` acceptor processes listening with SO_REUSEPORT. This
+    process becomes the collector, running the plugins and sharing their
+    state with the acceptors through shared memory.
+
+    Must be called before the plugins are started.
+
+    """
+    responders = share_plugins(
+        plugins, config.get('state_slot_size', StateSegment.SLOT_SIZE))
+    pool = WorkerPool(get_listen(args, config), workers,
+                      make_handler(config, responders))
+    pool.start()
+    return pool
+
+
+def report_startup(started, indexed, loaded, registry):
+    """
+    Prints how long the startup steps and plugin imports took to stderr.
+
+    """
+    steps = [('setup and plugin index', indexed - started),
+             ('plugin imports and init', loaded - indexed)]
+    steps += [('  import {}'.format(name), seconds)
+              for name, seconds in sorted(registry.import_times.items())]
+    for step, seconds in steps:
+        sys.stderr.write('{:<40} {:>9.2f} ms\n'.format(step, seconds * 1000))
+    sys.stderr.write('{:<40} {:>9.2f} ms\n'.format('total',
+                                                   (loaded - started) * 1000))
+
+
 def main():
     parser = argparse.ArgumentParser(description="Haproxy agent check service")
     parser.add_argument("-c", "--config",
@@ -198,22 +258,65 @@ def main():
                         default=5555,
                         type=int,
                         help="listen port")
+    parser.add_argument("-w", "--workers",
+                        default=0,
+                        type=int,
+                        help="number of acceptor processes, 0 serves from "
+                             "a single process")
+    parser.add_argument("-e", "--engine",
+                        default='gevent',
+                        choices=['gevent', 'asyncio'],
+                        type=str,
+                        help="server engine, gevent monkey-patches the "
+                             "standard library")
     parser.add_argument("-l", "--loglevel",
                         default='info',
                         choices=['info', 'warn', 'debug', 'critical'],
                         type=str,
                         help="set logging level")
+    parser.add_argument("--profile-startup",
+                        action='store_true',
+                        help="report the time taken by every startup step "
+                             "and plugin import")
 
     args = parser.parse_args()
+    started = time.time()
+    if args.engine == 'gevent':
+        monkey.patch_all()
     setup_logging(args)
 
     config = load_configuration(args.config)
-    all_plugins = load_all_plugins(config['plugins_dir'])
-    plugin = load_plugin(all_plugins, config['plugins'])
-    start_plugin(plugin)
-
-    server = start_server(args, config, plugin)
-    setup_handlers(server, plugin)
+    registry = PluginRegistry(config.get('plugins_dir')).index()
+    indexed = time.time()
+    plugins = load_plugins(registry, config['plugins'])
+    loaded = time.time()
+    snapshot = load_snapshot(config, plugins)
+
+    if args.profile_startup:
+        report_startup(started, indexed, loaded, registry)
+
+    if args.engine == 'asyncio':
+        if config.get('workers', args.workers):
+            logger.critical('workers are only supported by the gevent engine')
+            sys.exit()
+        from .aioserver import serve
+        serve(get_listen(args, config), config, plugins, snapshot)
+        return
+
+    workers = config.get('workers', args.workers)
+    if workers:
+        server = start_workers(args, config, plugins, workers)
+
+    scheduler = GeventScheduler(jitter=config.get('jitter', 0),
+                                spread=config.get('schedule_spread', True))
+    scheduler.start()
+    for plugin in plugins:
+        start_plugin(plugin, scheduler)
+    metrics_server = metrics.start_metrics_server(config, plugins, scheduler)
+
+    if not workers:
+        server = start_server(args, config, plugins)
+    setup_handlers(server, scheduler, plugins, snapshot, metrics_server)
     gevent.wait()
 
 if __name__ == "__main__":
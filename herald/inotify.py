@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Minimal inotify binding, through ctypes so nothing needs to be compiled.
+
+`available` is False where inotify is missing, e.g. on other platforms than
+linux, callers then fall back to polling.
+
+"""
+
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+# event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+# struct inotify_event header, followed by `len` bytes of NUL padded name
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_SIZE = 65536
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+LIBC = load_libc()
+
+available = LIBC is not None
+
+
+def check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify(object):
+    """
+    A non-blocking inotify instance, `fd` becomes readable when events are
+    queued and `read` returns them.
+
+    """
+
+    def __init__(self):
+        self.fd = check(LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        """
+        Watches `path` for the events in `mask`, returns the watch
+        descriptor.
+
+        """
+        return check(LIBC.inotify_add_watch(
+            self.fd, ctypes.c_char_p(os.fsencode(path)),
+            ctypes.c_uint32(mask)))
+
+    def read(self):
+        """
+        Returns the queued events as (wd, mask, name) tuples, without
+        blocking.
+
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            if not data:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
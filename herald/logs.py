@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Non-blocking logging for the request and poll paths.
+
+Loggers only put records on a queue, they are formatted and written to the
+output handlers (stderr and syslog) by a listener on a native thread, even
+when gevent has monkey-patched threading. Records logged with
+`extra=RATE_LIMITED` are let through at most once per `rate_limit` seconds
+for the same logger and message, with the count of the dropped ones.
+
+"""
+
+import os
+import sys
+import time
+import atexit
+import logging
+import logging.handlers
+from gevent import monkey
+
+try:
+    # the C implementation, never patched by gevent
+    from _queue import SimpleQueue
+except ImportError:
+    from queue import Queue as SimpleQueue
+
+# pass as `extra` to rate limit a hot path message
+RATE_LIMITED = {'rate_limited': True}
+
+# default seconds between two rate limited records of the same message
+RATE_LIMIT = 60
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+
+PIPELINE = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops `rate_limited` records repeating the same logger and message
+    within `interval` seconds. The next one let through reports how many
+    were dropped.
+
+    """
+
+    def __init__(self, interval=RATE_LIMIT):
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        # (logger name, message) -> [last emitted, dropped since]
+        self.seen = {}
+
+    def filter(self, record):
+        if not getattr(record, 'rate_limited', False):
+            return True
+        key = (record.name, record.msg)
+        now = time.time()
+        seen = self.seen.get(key)
+        if seen is None:
+            self.seen[key] = [now, 0]
+            return True
+        if now - seen[0] < self.interval:
+            seen[1] += 1
+            return False
+        if seen[1]:
+            message = record.getMessage()
+            record.msg = '%s (%d similar messages dropped in the last %.0fs)'
+            record.args = (message, seen[1], now - seen[0])
+        seen[0], seen[1] = now, 0
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records as they are, leaving the message formatting to the
+    listener thread.
+
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class LogListener(object):
+    """
+    Writes the queued records to `handlers` from a native thread.
+
+    """
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.stopped = monkey.get_original('_thread', 'allocate_lock')()
+
+    def start(self):
+        self.stopped.acquire()
+        start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+        start_new_thread(self.run, ())
+
+    def run(self):
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+        finally:
+            self.stopped.release()
+
+    def stop(self, timeout=1):
+        """
+        Writes out the records queued so far and stops the thread.
+
+        """
+        self.queue.put(None)
+        if self.stopped.acquire(True, timeout):
+            self.stopped.release()
+
+
+class LogPipeline(object):
+    """
+    Routes the root logger through a queue to `handlers`.
+
+    """
+
+    def __init__(self, handlers, rate_limit=RATE_LIMIT):
+        self.handlers = handlers
+        self.handler = LazyQueueHandler(SimpleQueue())
+        self.handler.addFilter(RateLimitFilter(rate_limit))
+        self.listener = LogListener(self.handler.queue, handlers)
+
+    def start(self):
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def after_fork(self):
+        """
+        Starts a new queue and listener in a forked child, the thread of
+        the parent's listener does not exist there.
+
+        """
+        self.handler.queue = SimpleQueue()
+        self.listener = LogListener(self.handler.queue, self.handlers)
+        self.listener.start()
+
+    def stop(self):
+        """
+        Writes out the queued records and closes the handlers, while the
+        interpreter, and gevent, are still fully alive.
+
+        """
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+        del self.handlers[:]
+
+
+def setup_pipeline(loglevel, rate_limit=RATE_LIMIT):
+    """
+    Logs at `loglevel` to stderr, and to syslog on linux, through the queue.
+    Returns the pipeline.
+
+    """
+    global PIPELINE
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [stream]
+    if sys.platform.startswith('linux') and os.path.exists('/dev/log'):
+        handlers.append(logging.handlers.SysLogHandler(address='/dev/log'))
+
+    logging.getLogger().setLevel(loglevel)
+    PIPELINE = LogPipeline(handlers, rate_limit)
+    PIPELINE.start()
+    return PIPELINE
+
+
+def after_fork():
+    if PIPELINE is not None:
+        PIPELINE.after_fork()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Herald self-instrumentation, exposed in the OpenMetrics text format.
+
+Instrumentation is disabled unless `enable` is called, which the engines do
+when `metrics_port` is configured. The hot paths only check whether
+`REGISTRY` is set, everything else is skipped while it is None.
+
+"""
+
+import re
+import time
+import bisect
+import logging
+from . import baseplugin
+
+logger = logging.getLogger('Herald')
+
+# set by `enable`, None while instrumentation is disabled
+REGISTRY = None
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# how long to wait for a scrape's request headers, and their maximum size
+REQUEST_TIMEOUT = 5
+REQUEST_MAX_SIZE = 8192
+
+WEIGHT_REGEX = re.compile(r'(\d+)%')
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape(v))
+                          for k, v in labels) + '}'
+
+
+class Histogram(object):
+    """
+    Histogram of observations, keyed by a tuple of (name, value) labels.
+
+    """
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self, lines):
+        lines.append('# TYPE {} histogram'.format(self.name))
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(self.name,
+                                              format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(self.name,
+                                                format_labels(labels),
+                                                cumulative))
+
+
+class Counter(object):
+    """
+    Counter keyed by a tuple of (name, value) labels.
+
+    """
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self, lines):
+        lines.append('# TYPE {} counter'.format(self.name))
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        for labels, value in sorted(self.series.items()):
+            lines.append('{}_total{} {}'.format(self.name,
+                                                format_labels(labels), value))
+
+
+def render_samples(lines, name, kind, help, samples):
+    """
+    Renders a metric family from (labels, value) samples, read from the
+    plugins at scrape time.
+
+    """
+    lines.append('# TYPE {} {}'.format(name, kind))
+    lines.append('# HELP {} {}'.format(name, help))
+    suffix = '_total' if kind == 'counter' else ''
+    for labels, value in samples:
+        lines.append('{}{}{} {}'.format(name, suffix, format_labels(labels),
+                                        value))
+
+
+class MetricsRegistry(object):
+    """
+    Collects herald's own metrics.
+
+    Latencies are observed as they happen. The plugin state, weight and
+    counters the plugins already keep are read when scraped.
+
+    """
+
+    def __init__(self, plugins, scheduler=None):
+        self.plugins = plugins
+        self.scheduler = scheduler
+        self.response_seconds = Histogram(
+            'herald_response_seconds',
+            'Time to answer an agent check, by plugin.')
+        self.run_seconds = Histogram(
+            'herald_run_seconds', 'Duration of plugin runs.')
+        self.rules_seconds = Histogram(
+            'herald_rules_seconds', 'Duration of plugin rules evaluation.')
+        self.responses = Counter(
+            'herald_responses',
+            'Agent check responses by plugin and kind, state, stale, '
+            'degraded or default.')
+
+    def observe_response(self, plugin, response, seconds):
+        labels = plugin_labels(plugin)
+        self.response_seconds.observe(labels, seconds)
+        if not isinstance(plugin, baseplugin.HeraldPlugin):
+            kind = 'state'
+        elif response is plugin.rendered_staleness_response:
+            kind = 'stale'
+        elif plugin.degraded and response is plugin.rendered_degraded_response:
+            kind = 'degraded'
+        elif plugin.state['value'] == plugin.default_response:
+            kind = 'default'
+        else:
+            kind = 'state'
+        self.responses.inc(labels + (('response', kind),))
+
+    def render(self):
+        """
+        Returns the metrics in the OpenMetrics text format.
+
+        """
+        lines = []
+        for family in (self.response_seconds, self.responses,
+                       self.run_seconds, self.rules_seconds):
+            family.render(lines)
+
+        plugins = [(p, plugin_labels(p)) for p in self.plugins
+                   if isinstance(p, baseplugin.HeraldPlugin)]
+        now = time.time()
+
+        render_samples(lines, 'herald_plugin_state', 'gauge',
+                       'Current plugin state, the state label is set to 1.',
+                       [(labels + (('state', p.state['value']),), 1)
+                        for p, labels in plugins])
+        weights = []
+        for p, labels in plugins:
+            weight = WEIGHT_REGEX.search(str(p.state['value']))
+            if weight:
+                weights.append((labels, int(weight.group(1))))
+        render_samples(lines, 'herald_plugin_weight', 'gauge',
+                       'Weight percentage in the current plugin state.',
+                       weights)
+        render_samples(lines, 'herald_plugin_state_age_seconds', 'gauge',
+                       'Seconds since the plugin state was updated.',
+                       [(labels, now - p.state['timestamp'])
+                        for p, labels in plugins])
+        render_samples(lines, 'herald_plugin_interval_seconds', 'gauge',
+                       'Current poll interval, adapted if adaptive_interval '
+                       'is set.',
+                       [(labels, p.effective_interval)
+                        for p, labels in plugins if p.interval])
+        render_samples(lines, 'herald_plugin_schedule_lag_seconds', 'gauge',
+                       'How late the last scheduled poll started.',
+                       [(labels, p.schedule_lag) for p, labels in plugins
+                        if hasattr(p, 'schedule_lag')])
+        render_samples(lines, 'herald_plugin_run_timeouts', 'counter',
+                       'Runs that exceeded run_timeout.',
+                       [(labels, p.run_timeouts) for p, labels in plugins])
+        render_samples(lines, 'herald_plugin_run_overruns', 'counter',
+                       'Ticks skipped as the previous run was still going.',
+                       [(labels, p.run_overruns) for p, labels in plugins])
+        breakers = [(p, labels) for p, labels in plugins
+                    if p.breaker is not None]
+        render_samples(lines, 'herald_plugin_breaker_state', 'gauge',
+                       'Circuit breaker state, the state label is set to 1.',
+                       [(labels + (('state', p.breaker.state),), 1)
+                        for p, labels in breakers])
+        render_samples(lines, 'herald_plugin_breaker_trips', 'counter',
+                       'Times the circuit breaker opened.',
+                       [(labels, p.breaker.trips) for p, labels in breakers])
+        render_samples(lines, 'herald_plugin_state_updates', 'counter',
+                       'State updates, by whether they changed the state.',
+                       [(labels + (('changed', changed),), count)
+                        for p, labels in plugins
+                        for changed, count in (('true', p.state_misses),
+                                               ('false', p.state_hits))])
+        rules = []
+        for p, labels in plugins:
+            for kind, attr in (('patterns', 'hp'), ('thresholds', 'ht')):
+                r = getattr(p, attr, None)
+                if r is not None:
+                    rules.append((labels + (('rules', kind),
+                                            ('memoized', 'true')), r.hits))
+                    rules.append((labels + (('rules', kind),
+                                            ('memoized', 'false')), r.misses))
+        render_samples(lines, 'herald_plugin_rule_evaluations', 'counter',
+                       'Rule evaluations, by whether the last result was '
+                       'reused.', rules)
+
+        if self.scheduler is not None:
+            render_samples(lines, 'herald_scheduler_lag_seconds', 'gauge',
+                           'How late the last scheduled poll started.',
+                           [((), self.scheduler.lag)])
+            render_samples(lines, 'herald_scheduler_max_lag_seconds', 'gauge',
+                           'Maximum lag of the scheduled polls.',
+                           [((), self.scheduler.max_lag)])
+            render_samples(lines, 'herald_scheduler_skipped_ticks', 'counter',
+                           'Ticks skipped as they were missed entirely.',
+                           [((), self.scheduler.skipped)])
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def enable(plugins, scheduler=None):
+    """
+    Starts collecting metrics, returns the registry.
+
+    """
+    global REGISTRY
+    REGISTRY = MetricsRegistry(plugins, scheduler)
+    return REGISTRY
+
+
+def plugin_labels(plugin):
+    return (('plugin', plugin.name),)
+
+
+def http_response(request):
+    """
+    Returns the HTTP response to a scrape request line.
+
+    """
+    parts = request.split(b' ')
+    if len(parts) < 2 or parts[0] != b'GET':
+        status, body, content_type = ('405 Method Not Allowed', b'',
+                                      'text/plain')
+    elif parts[1].split(b'?')[0] not in (b'/', b'/metrics'):
+        status, body, content_type = '404 Not Found', b'', 'text/plain'
+    else:
+        status, content_type = '200 OK', CONTENT_TYPE
+        body = REGISTRY.render().encode('UTF-8')
+    head = ('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+            'Connection: close\r\n\r\n'.format(status, content_type,
+                                               len(body)))
+    return head.encode('ascii') + body
+
+
+def handle_scrape(socket, addr):
+    """
+    gevent StreamServer handler answering metric scrapes.
+
+    """
+    socket.settimeout(REQUEST_TIMEOUT)
+    request = b''
+    try:
+        while b'\r\n\r\n' not in request and len(request) < REQUEST_MAX_SIZE:
+            chunk = socket.recv(REQUEST_MAX_SIZE)
+            if not chunk:
+                break
+            request += chunk
+        socket.sendall(http_response(request.split(b'\r\n', 1)[0]))
+    except Exception as e:
+        logger.warning('failed to answer metrics scrape: %s', e)
+
+
+def start_metrics_server(config, plugins, scheduler):
+    """
+    Enables the metrics and serves them with gevent on `metrics_port`, if
+    configured. Returns the server or None.
+
+    """
+    port = config.get('metrics_port')
+    if not port:
+        return None
+    from gevent.server import StreamServer
+    enable(plugins, scheduler)
+    listen = (config.get('metrics_bind', config.get('bind', '0.0.0.0')), port)
+    server = StreamServer(listen, handle_scrape)
+    server.start()
+    logger.info('serving metrics on %s', listen)
+    return server
+
@@ -1,14 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
-from herald.baseplugin import HeraldPlugin
+import os
+from herald import inotify
+from herald.baseplugin import HeraldPlugin, UNCHANGED
+
+# changes of the file in its directory, including replacing it by renaming
+# another file over it
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+              inotify.IN_MOVED_FROM | inotify.IN_CREATE | inotify.IN_DELETE)
+
+
+def stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
 
 
 class FilePlugin(HeraldPlugin):
     """
     Reads state from the provided file. If `is_json` is set file
-    contents are parsed using json.
+    contents are parsed using json, decoding only the keys the rule metrics
+    read.
+
+    The file is only read again once its inode, size or modification time
+    changed, otherwise a poll keeps the current state. Contents the rules
+    failed on are read again on the next poll.
+
+    With `watch` set, the directory of the file is watched with inotify,
+    and a poll runs as soon as the file is written or replaced, e.g. by
+    renaming a new file over it. The polls every `interval` go on as a
+    fallback. Without inotify, only those polls run.
 
     """
     # TODO: Make this generic for any file like object, like sockets
@@ -19,25 +39,121 @@ class FilePlugin(HeraldPlugin):
         super(FilePlugin, self).__init__(*args, **kwargs)
         self.file_path = kwargs['file_path']
         self.is_json = kwargs.get('is_json', False)
+        self.watch = kwargs.get('watch', False)
+
+        self.last_stat = None
+        # the stat of the last read, kept once its result made the state
+        self.pending_stat = None
+        self.inotify = None
+        # set by file events, the next run reads the file whatever its stat
+        self.force_read = False
+        self.changed_during_run = False
+
+    def start(self):
+        super(FilePlugin, self).start()
+        if self.watch and self.interval:
+            self.start_watching()
+
+    def start_watching(self):
+        if not inotify.available:
+            self.logger.warning('inotify is not available, polling %s every '
+                                '%ss', self.file_path, self.interval)
+            return
+        if not hasattr(self.scheduler, 'watch'):
+            self.logger.warning('cannot watch %s without a scheduler, '
+                                'polling it every %ss', self.file_path,
+                                self.interval)
+            return
+        directory, self.file_name = os.path.split(
+            os.path.abspath(self.file_path))
+        self.inotify = inotify.Inotify()
+        try:
+            self.inotify.add_watch(directory, WATCH_MASK)
+        except OSError as e:
+            self.logger.warning('could not watch %s, polling it every %ss: '
+                                '%s', directory, self.interval, e)
+            self.inotify.close()
+            self.inotify = None
+            return
+        self.scheduler.watch(self, self.inotify.fd, self.file_events)
+        self.logger.debug('watching %s', self.file_path)
+
+    def file_events(self):
+        """
+        Polls as soon as the queued events show the file changed. A change
+        during a poll is polled again once it ends.
+
+        """
+        if self.inotify is None:
+            return
+        changed = False
+        for _, mask, name in self.inotify.read():
+            if mask & inotify.IN_IGNORED:
+                self.logger.warning('%s is no longer watched, polling it '
+                                    'every %ss', self.file_path,
+                                    self.interval)
+                self.stop_watching()
+                return
+            if name == self.file_name or mask & inotify.IN_Q_OVERFLOW:
+                changed = True
+        if not changed:
+            return
+        self.force_read = True
+        if self.running:
+            self.changed_during_run = True
+        else:
+            self.scheduler.trigger(self)
+
+    def end_run(self):
+        super(FilePlugin, self).end_run()
+        if self.changed_during_run:
+            self.changed_during_run = False
+            self.scheduler.trigger(self)
+
+    def stop_watching(self):
+        if self.inotify is not None:
+            self.scheduler.unwatch(self)
+            self.inotify.close()
+            self.inotify = None
 
     def run(self):
+        force_read, self.force_read = self.force_read, False
+        self.pending_stat = None
         try:
+            if (not force_read and self.last_stat is not None and
+                    stat_key(os.stat(self.file_path)) == self.last_stat):
+                return UNCHANGED
+            # the stat of what is actually read, the file may have been
+            # replaced since
+            self.last_stat = None
             with open(self.file_path) as f:
+                st = os.fstat(f.fileno())
                 file_contents = f.read()
-            self.logger.debug('read %s from file %s' % (file_contents,
-                                                        self.file_path))
-        except IOError as e:
-                self.logger.critical('could not read file, error: %s' % str(e))
+            self.logger.debug('read %s from file %s',
+                              file_contents, self.file_path)
+        except (IOError, OSError) as e:
+                self.logger.critical('could not read file, error: %s', e)
                 return
 
         if self.is_json:
             try:
-                return json.loads(file_contents)
+                result = self.loads_json(file_contents)
             except ValueError as e:
-                    self.logger.critical('json parsing failed on file'
-                                         ' contents: %s' % str(file_contents))
+                    self.logger.critical('json parsing failed on file '
+                                         'contents: %s', file_contents)
+                    return
         else:
-            return file_contents
+            result = file_contents
+        self.pending_stat = stat_key(st)
+        return result
+
+    def run_succeeded(self):
+        if self.pending_stat is not None:
+            self.last_stat, self.pending_stat = self.pending_stat, None
+
+    def stop(self):
+        self.stop_watching()
+        super(FilePlugin, self).stop()
 
     def __str__(self):
         return self.name + ' ' + self.file_path
@@ -4,54 +4,409 @@
 from future import standard_library
 standard_library.install_aliases()
 from builtins import str
-from gevent import monkey
-monkey.patch_all()
 
-import urllib.request, urllib.error, urllib.parse
+import http.client
+import urllib.parse
+import threading
+import weakref
 import socket
-import json
-from herald.baseplugin import HeraldPlugin
+import gevent
+import gevent.pool
+from gevent import monkey
+from concurrent.futures import ThreadPoolExecutor
+from herald import projection
+from herald.logs import RATE_LIMITED
+from herald.baseplugin import (HeraldPlugin, RunTimeout, UNCHANGED,
+                               run_deadline)
+
+# idle keep-alive connections kept per target
+POOL_SIZE = 4
+
+# redirects followed, and how many at most, as urllib does
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+SCHEMES = ('http', 'https', 'http+unix')
+
+# errors of a reused keep-alive connection the server may have closed
+# meanwhile, the request is retried once on a new connection
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                           http.client.BadStatusLine,
+                           ConnectionResetError, BrokenPipeError)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection to a unix domain socket.
+
+    """
+
+    def __init__(self, path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive connections to the HTTP targets, shared by all the plugins.
+
+    A target is a (scheme, netloc) pair. The http+unix scheme connects to
+    the unix socket whose percent-encoded path is the netloc, e.g.
+    http+unix://%2Fvar%2Frun%2Fapp.sock/health.
+
+    gevent sockets can only be used in the thread of the hub they were
+    made in, so under gevent the idle connections are kept per hub, e.g.
+    for the runs of the thread executor.
+
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = {}
+        self.idle_by_hub = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def idle_connections(self):
+        """
+        Returns the idle connections by target usable from this thread, to
+        be called with the lock held.
+
+        """
+        if monkey.is_module_patched('socket'):
+            return self.idle_by_hub.setdefault(gevent.get_hub(), {})
+        return self.idle
+
+    def connect(self, target, timeout):
+        scheme, netloc = target
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=timeout)
+        elif scheme == 'http+unix':
+            return UnixHTTPConnection(urllib.parse.unquote(netloc),
+                                      timeout=timeout)
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+
+    def get(self, target, timeout):
+        """
+        Returns an idle connection to target if there is one, and whether it
+        is reused, else a new one.
+
+        """
+        with self.lock:
+            idle = self.idle_connections().get(target)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            return self.connect(target, timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def put(self, target, conn):
+        with self.lock:
+            idle = self.idle_connections().setdefault(target, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, target, path, headers, timeout):
+        """
+        GETs path from target, returns the response with its body read.
+
+        A reused connection that fails as the server closed it is retried on
+        a new one.
+
+        """
+        conn, reused = self.get(target, timeout)
+        while True:
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.body = response.read()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self.connect(target, timeout), False
+                continue
+            except BaseException:
+                # including a gevent.Timeout interrupting the request
+                conn.close()
+                raise
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.put(target, conn)
+        return response
+
+
+POOL = ConnectionPool()
+
+
+def host_header(target):
+    scheme, netloc = target
+    return 'localhost' if scheme == 'http+unix' else netloc
+
+
+def redirect_location(target, path, location):
+    """
+    Returns the target and path that a `Location` header redirects the
+    request of path from target to.
+
+    """
+    scheme, netloc = target
+    url = urllib.parse.urlsplit(urllib.parse.urljoin(
+        'http://{}{}'.format(netloc, path), location))
+    scheme = urllib.parse.urlsplit(location).scheme or scheme
+    if scheme not in SCHEMES:
+        raise http.client.HTTPException(
+            'redirected to an unsupported url: {}'.format(location))
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    return (scheme, url.netloc), path
+
+
+class Endpoint(object):
+    """
+    A health url, with the validators and result of its last response.
+
+    The validators of a response are pending until its result made the
+    plugin state, see `HTTPPlugin.run_succeeded`.
+
+    """
+
+    def __init__(self, url):
+        self.url = url
+        url = urllib.parse.urlsplit(url)
+        assert url.scheme in SCHEMES, \
+            'url scheme must be http, https or http+unix: {}'.format(self.url)
+        self.target = (url.scheme, url.netloc)
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.etag = None
+        self.last_modified = None
+        self.pending_validators = None
+        self.last_result = None
+
+    def request(self, timeout):
+        """
+        GETs the url, following at most MAX_REDIRECTS redirects.
+
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        target, path = self.target, self.path
+        for _ in range(MAX_REDIRECTS + 1):
+            headers['Host'] = host_header(target)
+            response = POOL.request(target, path, headers, timeout)
+            location = response.getheader('Location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                return response
+            target, path = redirect_location(target, path, location)
+        raise http.client.HTTPException(
+            'more than {} redirects'.format(MAX_REDIRECTS))
+
+    def __str__(self):
+        return self.url
+
+
+def mean(values):
+    return float(sum(values)) / len(values)
+
+
+# how the values of a key are aggregated across the `urls` of a plugin
+AGGREGATIONS = {'sum': sum, 'max': max, 'min': min, 'mean': mean}
+
+# default number of `urls` polled at the same time
+CONCURRENCY = 8
 
 
 class HTTPPlugin(HeraldPlugin):
     """
     Reads state from the passed in URI
 
+    Connections are kept alive between polls, redirects are followed but
+    proxies set in the environment, like http_proxy, are not used. The ETag
+    and Last-Modified of the last response that made the state are sent
+    back, and a 304 Not Modified keeps the current state without parsing
+    the response or processing the rules.
+
+    The url can be a unix domain socket with the http+unix scheme, the
+    socket path being percent-encoded as the host, e.g.
+    http+unix://%2Fvar%2Frun%2Fapp.sock/health.
+
+    With `urls` instead of `url`, all the urls are polled concurrently, at
+    most `concurrency` at a time, each within `request_timeout`. The result
+    is a dict of the `aggregate` keys, each aggregated with sum, max, min or
+    mean over the endpoints that have it, along with the count of
+    `healthy` endpoints, that answered (and parsed with `is_json`), and of
+    all the `endpoints`.
+
     """
     herald_plugin_name = 'herald_http'
 
     def __init__(self, *args, **kwargs):
         super(HTTPPlugin, self).__init__(*args, **kwargs)
-        self.url = kwargs['url']
+        self.url = kwargs.get('url')
+        self.urls = kwargs.get('urls')
         self.is_json = kwargs.get('is_json', False)
+        assert bool(self.url) != bool(self.urls), \
+            'exactly one of url and urls must be set'
+
+        self.endpoints = [Endpoint(url) for url in self.urls or [self.url]]
+
+        self.concurrency = kwargs.get('concurrency', CONCURRENCY)
+        assert isinstance(self.concurrency, int) and self.concurrency > 0, \
+            'concurrency is not a positive integer: {}'.format(
+                self.concurrency)
+        self.request_timeout = kwargs.get('request_timeout')
+        self.aggregate = kwargs.get('aggregate') or {}
+        for key, aggregation in self.aggregate.items():
+            assert aggregation in AGGREGATIONS, \
+                'aggregation of {} must be one of {}: {}'.format(
+                    key, ', '.join(sorted(AGGREGATIONS)), aggregation)
 
-    def run(self, timeout=10):
-        req = urllib.request.Request(self.url)
+        # every response is parsed down to the aggregated keys
+        if self.urls and self.json_projection is not None:
+            self.json_projection = projection.Projection(
+                set((key,) for key in self.aggregate))
+
+    def run(self, timeout=None):
+        timeout = timeout or self.run_timeout or 10
+        if self.urls:
+            return self.run_all(self.request_timeout or timeout)
+        return self.poll_endpoint(self.endpoints[0], timeout)
+
+    def poll_endpoint(self, endpoint, timeout):
+        """
+        Polls a single endpoint, returns its result or UNCHANGED on a 304.
+
+        """
         response = ''
+        endpoint.pending_validators = None
         try:
-            infourl = urllib.request.urlopen(req, timeout=timeout)
-        except urllib.error.HTTPError as e:            
-            self.logger.warning('HTTPError: get failed, http code: %s', e.code)
-        except urllib.error.URLError as e:
-            self.logger.critical('URLError: failed to reach a server, '
-                                 'reason: %s', e.reason)
+            resp = endpoint.request(timeout)
         except socket.timeout:
-            self.logger.warning('SocketTimeout: the request timed out!')
+            self.logger.warning('SocketTimeout: the request to %s timed out!',
+                                endpoint)
+            resp = None
+        except (http.client.HTTPException, OSError) as e:
+            self.logger.critical('failed to reach %s, reason: %s',
+                                 endpoint, e)
+            resp = None
         else:
-            response = ''.join(infourl.readlines())
-            self.logger.debug('got response: %s', response)
+            if resp.status == 304:
+                self.logger.debug('%s not modified', endpoint)
+                return UNCHANGED
+            elif resp.status >= 300:
+                # including redirects without a Location
+                self.logger.warning('HTTPError: get %s failed, http code: %s',
+                                    endpoint, resp.status)
+                resp = None
+            else:
+                response = resp.body.decode('UTF-8')
+                self.logger.debug('got response: %s', response)
 
+        # no conditional request until a response made the state
+        endpoint.etag = endpoint.last_modified = None
+        if resp is None:
+            return None if self.is_json else ''
         if self.is_json:
             try:
-                return json.loads(response)
+                result = self.loads_json(response)
             except ValueError as e:
-                    self.logger.critical('json parsing failed on response:'
-                                         ' %s' % str(response))
+                    self.logger.critical('json parsing failed on response: '
+                                         '%s', response)
+                    return
         else:
-            return response
+            result = response
+        if response:
+            endpoint.pending_validators = (resp.getheader('ETag'),
+                                           resp.getheader('Last-Modified'))
+        return result
+
+    def run_succeeded(self):
+        for endpoint in self.endpoints:
+            if endpoint.pending_validators is not None:
+                endpoint.etag, endpoint.last_modified = \
+                    endpoint.pending_validators
+                endpoint.pending_validators = None
+
+    def poll_concurrently(self, timeout):
+        """
+        Polls every endpoint, at most `concurrency` at a time, and returns
+        their results. A poll that outlives `timeout` results in None.
+
+        A gevent pool runs the polls when gevent has monkey-patched the
+        sockets, else a thread pool.
+
+        """
+        def poll(endpoint):
+            try:
+                with run_deadline(timeout):
+                    return self.poll_endpoint(endpoint, timeout)
+            except RunTimeout:
+                self.logger.warning('request to %s exceeded %ss', endpoint,
+                                    timeout, extra=RATE_LIMITED)
+
+        if monkey.is_module_patched('socket'):
+            pool = gevent.pool.Pool(self.concurrency)
+            try:
+                return pool.map(poll, self.endpoints)
+            finally:
+                pool.kill()
+        with ThreadPoolExecutor(min(self.concurrency,
+                                    len(self.endpoints))) as executor:
+            return list(executor.map(poll, self.endpoints))
+
+    def run_all(self, timeout):
+        """
+        Polls all the `urls` and aggregates their results. Returns UNCHANGED
+        if none of them changed.
+
+        """
+        results = self.poll_concurrently(timeout)
+        if all(result is UNCHANGED for result in results):
+            return UNCHANGED
+
+        healthy = []
+        for endpoint, result in zip(self.endpoints, results):
+            if result is not UNCHANGED:
+                # None and '' are failed polls
+                endpoint.last_result = None if result == '' else result
+            if endpoint.last_result is not None:
+                healthy.append(endpoint.last_result)
+
+        aggregated = {}
+        for key, aggregation in self.aggregate.items():
+            values = [r[key] for r in healthy if isinstance(r, dict) and
+                      isinstance(r.get(key), (int, float)) and
+                      not isinstance(r[key], bool)]
+            if values:
+                aggregated[key] = AGGREGATIONS[aggregation](values)
+        aggregated['healthy'] = len(healthy)
+        aggregated['endpoints'] = len(self.endpoints)
+        return aggregated
 
     def __str__(self):
-        return self.name + ' ' + self.url
+        return self.name + ' ' + ' '.join(map(str, self.endpoints))
 
     def __unicode__(self):
-        return self.name + ' ' + self.url
+        return self.name + ' ' + ' '.join(map(str, self.endpoints))
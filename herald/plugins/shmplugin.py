@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+from functools import partial
+from herald.logs import RATE_LIMITED
+from herald.baseplugin import HeraldPlugin, UNCHANGED
+from herald.shm import seqlock_read, READ_RETRIES
+from herald.shmmetrics import (read_layout, SEQUENCE, SEQUENCE_OFFSET,
+                               RETIRED, RETIRED_OFFSET)
+
+
+class SharedMemoryPlugin(HeraldPlugin):
+    """
+    Reads the metrics an application publishes in shared memory with
+    `herald.shmmetrics.MetricsWriter`, the result is a dict of the metric
+    values by name, e.g. r['msg_rate'].
+
+    The file at `shm_path` is mapped on the first run, and again once the
+    writer retired it for a new one. A run only reads memory : the values
+    are copied while the sequence is even and unchanged (seqlock), and
+    UNCHANGED is returned if nothing was written since the last run.
+
+    """
+
+    herald_plugin_name = 'herald_shm'
+
+    def __init__(self, *args, **kwargs):
+        super(SharedMemoryPlugin, self).__init__(*args, **kwargs)
+        self.shm_path = kwargs['shm_path']
+        self.mm = None
+        self.layout = None
+        # unpacks the values from the mapped file
+        self.read_values = None
+        self.last_sequence = None
+
+    def map(self):
+        with open(self.shm_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.layout = read_layout(mm)
+        except Exception:
+            mm.close()
+            raise
+        self.mm = mm
+        self.read_values = partial(self.layout.values.unpack_from, mm,
+                                   self.layout.values_offset)
+        self.last_sequence = None
+        self.logger.debug('mapped %s with metrics %s', self.shm_path,
+                          ', '.join(self.layout.names))
+
+    def unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def run(self):
+        if (self.mm is not None and
+                RETIRED.unpack_from(self.mm, RETIRED_OFFSET)[0]):
+            self.logger.info('%s was replaced, mapping it again',
+                             self.shm_path)
+            self.unmap()
+        if self.mm is None:
+            try:
+                self.map()
+            except Exception as e:
+                self.logger.critical('could not map %s, error: %s',
+                                     self.shm_path, e)
+                return
+
+        # an odd sequence never equals the last one read
+        if SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0] == \
+                self.last_sequence:
+            return UNCHANGED
+        read = seqlock_read(self.mm, SEQUENCE_OFFSET, self.read_values)
+        if read is not None:
+            self.last_sequence, data = read
+            return dict(zip(self.layout.names, data))
+
+        self.logger.warning('no consistent read of %s in %s tries, a write '
+                            'is in progress', self.shm_path, READ_RETRIES,
+                            extra=RATE_LIMITED)
+
+    def stop(self):
+        super(SharedMemoryPlugin, self).stop()
+        self.unmap()
+
+    def __str__(self):
+        return self.name + ' ' + self.shm_path
+
+    def __unicode__(self):
+        return self.name + ' ' + self.shm_path
@@ -79,10 +79,10 @@ class SyscallPlugin(HeraldPlugin):
             self.__collect__()
             data = self.__process__()
             self.logger.debug(
-                'Statistics: \'health\': {}, \'use-rate\': {:.2f}%'.
-                    format(data['health'], data['use-rate']))
+                "Statistics: 'health': %s, 'use-rate': %.2f%%",
+                data['health'], data['use-rate'])
         except IOError as e:
-            self.logger.critical('could not read file, error: %s' % str(e))
+            self.logger.critical('could not read file, error: %s', e)
             return
 
         return data
@@ -166,11 +166,11 @@ class SyscallPlugin(HeraldPlugin):
             "networks": network_data,
         }
 
-        self.logger.debug('Load: {}'.format(messages))
+        self.logger.debug('Load: %s', messages)
         free_mem = mem_data['virtual']['available']
         if free_mem < self.available_mem_thd:
-            self.logger.fatal('Out of memory. Only {} bytes left!'.
-                              format(free_mem))
+            self.logger.critical('Out of memory. Only %s bytes left!',
+                                 free_mem)
             health_status = 'unhealthy'
         else:
             health_status = 'healthy'
@@ -178,9 +178,9 @@ class SyscallPlugin(HeraldPlugin):
         network_usage = network_data.get("bytes_sent", 0) * 100 * 8 \
                         / self.interval / self.nic_speed
         if network_usage > self.userate_thd:
-            self.logger.info('Network io used {:.2f}%'.format(network_usage))
+            self.logger.info('Network io used %.2f%%', network_usage)
         if self.cpu_percent_data > self.userate_thd:
-            self.logger.info('Cpu usage {:.2f}%'.format(self.cpu_percent_data))
+            self.logger.info('Cpu usage %.2f%%', self.cpu_percent_data)
 
         self.net_percent_data = self.net_percent_data * 0.7 + network_usage * 0.3
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Projected JSON parsing, decoding only the parts of a health payload that the
+rule metrics read.
+
+A `Projection` is built from the key paths of the metrics, see
+`rules.metric_key_paths`. It scans the top level object of a document and
+decodes the values of the wanted keys only. The other values are skipped
+without being kept, and the scan stops as soon as every wanted key was
+found, so the rest of the document is never looked at.
+
+Documents that are not an object, and metrics that read the whole result,
+are parsed in full, with orjson when it is installed.
+
+"""
+
+import re
+import json
+from json.decoder import WHITESPACE, scanstring
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DECODER = json.JSONDecoder()
+
+# the start of an object up to its first key, then the delimiters after a key
+# and after a value
+OBJECT_START = re.compile(r'\{[ \t\n\r]*(?:(\})|")')
+COLON = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
+NEXT_KEY = re.compile(r'[ \t\n\r]*(?:(\})|,[ \t\n\r]*")')
+
+
+def loads(text):
+    """
+    Parses a whole JSON document.
+
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def scan_value(text, idx):
+    """
+    Decodes the value at `idx` with the C scanner, returns it and the index
+    past its end.
+
+    """
+    try:
+        return DECODER.scan_once(text, idx)
+    except StopIteration as e:
+        raise ValueError('Expecting value at char {}'.format(e.value))
+
+
+def build_tree(paths):
+    """
+    Turns key paths into a tree of dicts, keys mapping to the subtree of
+    their wanted keys or to None if their whole value is wanted.
+
+    """
+    tree = {}
+    for path in sorted(paths, key=len):
+        node = tree
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+            if node is None:
+                break
+        else:
+            node[path[-1]] = None
+    return tree
+
+
+class Projection(object):
+    """
+    Parses the `paths` of JSON objects, each path a tuple of keys.
+
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.tree = build_tree(paths)
+
+    def loads(self, text):
+        """
+        Returns a dict holding only the wanted paths of the document in
+        `text`, or the whole document if it is not an object.
+
+        As the scan stops early, errors after the last wanted key are not
+        detected. Malformed JSON up to there raises ValueError.
+
+        """
+        idx = WHITESPACE.match(text, 0).end()
+        if not text.startswith('{', idx):
+            return loads(text)
+        return self.scan_object(text, idx, self.tree, True)[0]
+
+    def scan_object(self, text, idx, tree, stop_early=False):
+        """
+        Scans the object starting at `idx`, returns the dict of its wanted
+        keys and the index past its end. If `stop_early` the index is where
+        the scan stopped, after the last wanted key.
+
+        """
+        result = {}
+        wanted = len(tree)
+        m = OBJECT_START.match(text, idx)
+        if m is None:
+            raise ValueError('Expecting property name enclosed in double '
+                             'quotes at char {}'.format(idx))
+        if m.group(1) == '}':
+            return result, m.end()
+        idx = m.end()
+
+        while True:
+            key, idx = scanstring(text, idx)
+            m = COLON.match(text, idx)
+            if m is None:
+                raise ValueError("Expecting ':' delimiter at char "
+                                 "{}".format(idx))
+            idx = m.end()
+
+            if key in tree and key not in result:
+                subtree = tree[key]
+                if subtree is not None and text.startswith('{', idx):
+                    result[key], idx = self.scan_object(text, idx, subtree)
+                else:
+                    result[key], idx = scan_value(text, idx)
+                if stop_early and len(result) == wanted:
+                    return result, idx
+            else:
+                # decoded by the C scanner and dropped right away
+                idx = scan_value(text, idx)[1]
+
+            m = NEXT_KEY.match(text, idx)
+            if m is None:
+                raise ValueError("Expecting ',' delimiter at char "
+                                 "{}".format(idx))
+            if m.group(1) == '}':
+                return result, m.end()
+            idx = m.end()
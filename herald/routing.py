@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# seconds to wait for the agent-send line before using the default plugin
+AGENT_SEND_TIMEOUT = 0.1
+# haproxy limits agent-send to a single short line
+AGENT_SEND_MAX_SIZE = 1024
+
+
+def find_default_plugin(config, plugins):
+    """
+    Returns the plugin that answers requests which do not name a plugin,
+    or name one that is not configured.
+
+    The top level `default_plugin` key takes precedence, then the plugin
+    with the 'default' key, else the first one in the list is used.
+
+    """
+    by_name = dict((p.name, p) for p in plugins)
+    default_name = config.get('default_plugin')
+    if default_name is not None:
+        assert default_name in by_name, \
+            'default_plugin {} is not a configured plugin'.format(default_name)
+        return by_name[default_name]
+
+    for plugin_config in config['plugins']:
+        if plugin_config.get('default'):
+            return by_name[plugin_config['name']]
+
+    return plugins[0]
+
+
+def build_routes(config, plugins):
+    """
+    Builds the agent-send routing table.
+
+    Each plugin is reachable as "<client_name>/<plugin_name>", where the
+    client name is the top level `name` key, and as "<plugin_name>". The
+    keys are encoded so the raw agent-send line read off the socket can be
+    looked up directly.
+
+    """
+    client_name = config.get('name')
+    routes = {}
+    for plugin in plugins:
+        routes[plugin.name.encode('UTF-8')] = plugin
+        if client_name:
+            key = '{}/{}'.format(client_name, plugin.name)
+            routes[key.encode('UTF-8')] = plugin
+    return routes
+
+
+def route_request(routes, agent_send, default_plugin):
+    """
+    Returns the plugin that agent_send maps to, or default_plugin.
+
+    Unknown client names are tolerated as long as the plugin name matches.
+
+    """
+    agent_send = agent_send.strip()
+    if not agent_send:
+        return default_plugin
+    plugin = routes.get(agent_send)
+    if plugin is None:
+        plugin = routes.get(agent_send.rpartition(b'/')[2], default_plugin)
+    return plugin
+
+
+def get_agent_send_timeout(config, plugins):
+    """
+    Returns how long to wait for the agent-send line.
+
+    With a single plugin there is nothing to route, so agent-send is not
+    waited on at all.
+
+    """
+    if len(plugins) > 1:
+        return config.get('agent_send_timeout', AGENT_SEND_TIMEOUT)
+    return 0
@@ -8,7 +8,171 @@ from builtins import object
 from past.utils import old_div
 
 import re
+import ast
+import sys
 import logging
+import operator
+from collections import namedtuple
+from .logs import RATE_LIMITED
+
+# the numpy module once imported by `load_numpy`, False if it is missing
+NUMPY = None
+
+
+def load_numpy():
+    """
+    Returns the numpy module, or None if it is not installed. It is only
+    imported by the first bulk call, importing it slows down startup.
+
+    """
+    global NUMPY
+    if NUMPY is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        NUMPY = numpy
+    return NUMPY or None
+
+
+# functions that metric expressions may call
+METRIC_FUNCTIONS = {'min': min, 'max': max, 'sum': sum}
+
+# names that metric expressions may use, besides METRIC_FUNCTIONS
+METRIC_NAMES = ('r',)
+
+# literals parse as ast.Constant since python 3.8, and as one node per type
+# before, ast.Constant not even existing before 3.6
+if sys.version_info >= (3, 8):
+    LITERAL_NODES = (ast.Constant,)
+else:
+    LITERAL_NODES = (ast.Num, ast.Str, ast.Bytes, ast.NameConstant)
+
+# syntax allowed in metric expressions, i.e. subscripts, arithmetic and
+# comparisons. No attribute access, comprehensions, lambdas or `**`
+METRIC_NODES = LITERAL_NODES + tuple(node for node in (
+    ast.Expression, ast.Name, ast.Load, ast.Subscript,
+    ast.Slice, getattr(ast, 'Index', None), ast.Tuple, ast.List,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.UnaryOp, ast.UAdd, ast.USub, ast.Not,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn,
+    ast.Call) if node is not None)
+
+
+# metric values that can be memoized, i.e. immutable values compared by value
+MEMO_TYPES = (str, bytes, int, float, bool, type(None))
+
+# a parsed threshold rule, min_resp is only set for 'pct'
+ThresholdRule = namedtuple('ThresholdRule', 'action op threshold min_resp')
+
+
+def compile_metric(metric):
+    """
+    Parses and validates a metric expression and returns its compiled code.
+
+    Only the syntax in METRIC_NODES is allowed, names are limited to the
+    result `r` and the functions in METRIC_FUNCTIONS. Anything else raises an
+    exception, so unsafe expressions are rejected at config load.
+
+    """
+    try:
+        tree = ast.parse(str(metric).strip(), mode='eval')
+    except SyntaxError as e:
+        raise Exception('Error in parsing metric: {}, {}'.format(metric, e))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, METRIC_NODES):
+            raise Exception('Error in parsing metric: {}, {} is not '
+                            'allowed'.format(metric, type(node).__name__))
+        if (isinstance(node, ast.Name) and node.id not in METRIC_NAMES and
+                node.id not in METRIC_FUNCTIONS):
+            raise Exception('Error in parsing metric: {}, unknown name '
+                            '{}'.format(metric, node.id))
+        if isinstance(node, ast.Call) and (
+                not isinstance(node.func, ast.Name) or
+                node.func.id not in METRIC_FUNCTIONS or node.keywords):
+            raise Exception('Error in parsing metric: {}, only {} can be '
+                            'called'.format(metric,
+                                            ', '.join(METRIC_FUNCTIONS)))
+
+    return compile(tree, '<metric>', 'eval')
+
+
+def subscript_key(node):
+    """
+    Returns the string constant a subscript node indexes with, else None.
+
+    """
+    index = node.slice
+    if getattr(ast, 'Index', None) and isinstance(index, ast.Index):
+        index = index.value
+    if isinstance(index, LITERAL_NODES):
+        value = literal_value(index)
+        if isinstance(value, str):
+            return value
+    return None
+
+
+def literal_value(node):
+    """
+    Returns the value of a literal node, see LITERAL_NODES.
+
+    """
+    if sys.version_info >= (3, 8):
+        return node.value
+    for attr in ('s', 'n', 'value'):
+        if hasattr(node, attr):
+            return getattr(node, attr)
+
+
+def metric_key_paths(metric):
+    """
+    Returns the key paths of the result `r` that a metric expression reads,
+    as a set of tuples of keys.
+
+    e.g. :
+    >>> metric_key_paths("r['queues']['msg-rate'] + r['backlog']")
+    {('queues', 'msg-rate'), ('backlog',)}
+
+    A path stops at the first subscript that is not a string constant, like
+    a list index. Returns None if the metric may read any part of the
+    result, like `r` itself or `r[r['key']]`.
+
+    """
+    paths = set()
+
+    def visit(node):
+        if isinstance(node, ast.Subscript):
+            subscripts = []
+            base = node
+            while isinstance(base, ast.Subscript):
+                subscripts.insert(0, base)
+                base = base.value
+            if isinstance(base, ast.Name) and base.id == 'r':
+                path = []
+                for subscript in subscripts:
+                    key = subscript_key(subscript)
+                    if key is None:
+                        break
+                    path.append(key)
+                paths.add(tuple(path))
+                subscripts = subscripts[len(path):]
+            else:
+                visit(base)
+            for subscript in subscripts:
+                visit(subscript.slice)
+        elif isinstance(node, ast.Name) and node.id == 'r':
+            paths.add(())
+        else:
+            for child in ast.iter_child_nodes(node):
+                visit(child)
+
+    visit(ast.parse(str(metric).strip(), mode='eval'))
+    if () in paths:
+        return None
+    return paths
 
 
 class HeraldBaseRules(object):
@@ -23,12 +187,23 @@ class HeraldBaseRules(object):
         evaluation.
 
         e.g. :
-        >>> metric = 'r[msg-rate]'
+        >>> metric = "r['msg-rate']"
+
+        The expression is compiled once here, see `compile_metric`.
 
         """
         self.metric = metric
+        self.metric_code = compile_metric(metric)
+        self.metric_globals = dict(METRIC_FUNCTIONS, __builtins__={})
         self.logger = logging.getLogger(__name__)
 
+        # the last evaluated metric value and the action it resulted in
+        self.last_value = None
+        self.last_action = None
+        self.memoized = False
+        self.hits = 0
+        self.misses = 0
+
     def evaluate_metric(self, context):
         """
         Evaluate metric agaist the passed in context.
@@ -39,7 +214,7 @@ class HeraldBaseRules(object):
             'context must be a dictionary, got: {}'.format(context)
 
         try:
-            result = eval(self.metric, {}, context)
+            result = eval(self.metric_code, self.metric_globals, context)
         except Exception as e:
             raise Exception('Erorr in evaluating metric: {} against'
                             ' context: {}, exception is: {}'.format(
@@ -55,9 +230,22 @@ class HeraldBaseRules(object):
         metric. Second, the result of the evaluation is processed against the
         rules.
 
+        If the metric value is the same as the last one, the last action is
+        returned without processing the rules again (counted in `hits`).
+
         """
         result = self.evaluate_metric(context)
-        return self.process_rules(result)
+        if (self.memoized and type(result) is type(self.last_value) and
+                result == self.last_value):
+            self.hits += 1
+            return self.last_action
+
+        self.misses += 1
+        action = self.process_rules(result)
+        self.last_value = result
+        self.last_action = action
+        self.memoized = isinstance(result, MEMO_TYPES)
+        return action
 
     def process_rules(self, value):
         """
@@ -73,6 +261,10 @@ class HeraldPatterns(HeraldBaseRules):
 
     """
 
+    # numbered backreferences and conditionals, these refer to groups by
+    # position which changes once patterns are combined
+    group_ref_regex = re.compile(r'(?<!\\)\\[1-9]|\(\?\(\d')
+
     def __init__(self, rules, metric):
         """
         Instantiate object with the pattern rules and metric.
@@ -84,11 +276,49 @@ class HeraldPatterns(HeraldBaseRules):
                     - drain: '.*maxed.*'
                 ]
 
+        Patterns are validated and compiled here, and combined into a single
+        regex so one match finds the first matching rule.
+
         """
         super(HeraldPatterns, self).__init__(metric)
-        # TODO: add rule validation
         self.rules = rules
 
+        # (action, compiled pattern) tuples, in rule order
+        self._parsed_rules = []
+        for rule in self.rules:
+            try:
+                action, pattern = list(rule.items())[0]
+                self._parsed_rules.append((action, re.compile(str(pattern))))
+            except Exception as e:
+                raise Exception('Error in parsing pattern rules!: ' + str(e))
+
+        self.matcher, self.actions = self.combine_rules(self._parsed_rules)
+
+    def combine_rules(self, parsed_rules):
+        """
+        Combines the patterns into one alternation, each pattern wrapped in a
+        named group mapped to its action.
+
+        `re` tries alternatives in order at the start of the value, so the
+        first rule that matches wins as when matching them one by one.
+        Returns (None, None) if the patterns cannot be combined, for e.g.
+        when they use numbered backreferences.
+
+        """
+        actions = {}
+        alternatives = []
+        for index, (action, regex) in enumerate(parsed_rules):
+            if re.search(self.group_ref_regex, regex.pattern):
+                return None, None
+            name = '_herald_rule_{}'.format(index)
+            actions[name] = action
+            alternatives.append('(?P<{}>{})'.format(name, regex.pattern))
+
+        try:
+            return re.compile('|'.join(alternatives)), actions
+        except re.error:
+            return None, None
+
     def process_rules(self, value):
         """
         Processes rules against the passed in value.
@@ -98,13 +328,43 @@ class HeraldPatterns(HeraldBaseRules):
         `value` should be of type string.
 
         """
-        for rule in self.rules:
-            action, pattern = list(rule.items())[0]
-            if re.match(pattern, str(value)):
+        value = str(value)
+        if self.matcher is not None:
+            m = self.matcher.match(value)
+            return self.actions[m.lastgroup] if m else None
+
+        for action, regex in self._parsed_rules:
+            if regex.match(value):
                 return action
         else:
             return None
 
+    def process_rules_bulk(self, values):
+        """
+        Processes rules against a column of values, returns the action for
+        each value (None if no rule matched).
+
+        Each distinct value is matched once. With NumPy available `values`
+        may be an array, and an object array is returned, else a list.
+
+        """
+        numpy = load_numpy()
+        if numpy is not None:
+            uniques, inverse = numpy.unique(
+                numpy.asarray(values).astype(str), return_inverse=True)
+            actions = numpy.empty(len(uniques), dtype=object)
+            actions[:] = [self.process_rules(value) for value in uniques]
+            return actions[inverse.reshape(-1)]
+
+        cache = {}
+        actions = []
+        for value in values:
+            value = str(value)
+            if value not in cache:
+                cache[value] = self.process_rules(value)
+            actions.append(cache[value])
+        return actions
+
 
 class HeraldThresholds(HeraldBaseRules):
     """
@@ -119,7 +379,16 @@ class HeraldThresholds(HeraldBaseRules):
 
     """
 
-    op_regex = re.compile('^([!<>=]?)([0-9]+)')
+    op_regex = re.compile('^([!<>=]?)([0-9]+(?:\\.[0-9]+)?)')
+
+    # threshold operator prefixes and the comparison they stand for
+    operators = {
+        '': operator.eq,
+        '=': operator.eq,
+        '!': operator.ne,
+        '<': operator.lt,
+        '>': operator.gt,
+    }
 
     def __init__(self, rules, metric):
         """
@@ -141,21 +410,24 @@ class HeraldThresholds(HeraldBaseRules):
                 ]
 
         The supported operators for the thresholds are !, <, > and == (default).
+        Thresholds may be integers or decimals, like '>40.5'.
 
         """
         super(HeraldThresholds, self).__init__(metric)
         self.rules = rules
 
         self._parsed_rules = []
-        # validate thresholds hash and convert to an easier to parse
-        # tuple list of the form (action, op, threshold, <optional_field>) :
+        # validate thresholds hash and convert to typed ThresholdRule tuples
+        # of the form (action, op, threshold, min_resp), op being a function
+        # from the `operator` module :
         # _parsed_rules:
-        #   - ('drain', '>', '7000')
-        #   - ('pct', '==', '7000', 0)
+        #   - ('drain', operator.gt, 7000.0, None)
+        #   - ('pct', operator.eq, 7000.0, 1)
         for rule in self.rules:
             try:
                 # 'pct' is special, it can also have a 'min_threshold_response'
                 # key
+                min_resp = None
                 if 'pct' in rule:
                     action = 'pct'
                     threshold = rule['pct']
@@ -165,30 +437,71 @@ class HeraldThresholds(HeraldBaseRules):
                 m = re.match(self.op_regex, str(threshold))
                 op, th = m.groups()
 
-                if op == '' or op == '=':
-                    op = '=='
-                elif op == '!':
-                    op = '!='
-
-                # ensure threshold can be converted into int
                 # raises ValueError if this fails
-                int(th)
-
-                if action == 'pct':
-                    parsed_rule = (action, op, str(th), min_resp)
-                else:
-                    parsed_rule = (action, op, str(th))
+                parsed_rule = ThresholdRule(action, self.operators[op],
+                                            float(th), min_resp)
                 self._parsed_rules.append(parsed_rule)
             except Exception as e:
                 raise Exception('Error in parsing threshold rules!: ' + str(e))
 
+        self.decide = self.compile_rules(self._parsed_rules)
+
+    def compile_rules(self, parsed_rules):
+        """
+        Lowers the parsed rules into a single decision function, taking the
+        metric value as a float and returning the response.
+
+        The function is generated as python source, each rule becoming one
+        comparison against a constant, in rule order. Nothing after a `pct`
+        rule is reachable, as it always responds.
+
+        """
+        symbols = {operator.eq: '==', operator.ne: '!=',
+                   operator.lt: '<', operator.gt: '>'}
+        source = ['def decide(value):']
+        for rule in parsed_rules:
+            if rule.action == 'pct':
+                source.append('    return pct_response(value, {!r}, {!r})'.format(
+                    rule.threshold, rule.min_resp))
+                break
+            source.append('    if value {} {!r}:'.format(symbols[rule.op],
+                                                         rule.threshold))
+            source.append('        return {!r}'.format(rule.action))
+        else:
+            source.append('    return None')
+
+        namespace = {'pct_response': self.pct_response}
+        exec(compile('\n'.join(source), '<thresholds>', 'exec'), namespace)
+        return namespace['decide']
+
+    def pct_response(self, value, threshold, min_resp):
+        """
+        Calculates the percentage of traffic to be sent based on the
+        threshold, and returns the response for it.
+
+        """
+        pct = int(100 - ((old_div(value, threshold)) * 100))
+        if pct <= 0:
+            self.logger.warning('Pct value %s less than 0, responding with '
+                                'min threshold response %s', pct, min_resp,
+                                extra=RATE_LIMITED)
+            return str(min_resp) + '%'
+        # noop if pct is greater than 100
+        elif pct > 100:
+            self.logger.warning('Pct value %s greater than 100 responding '
+                                'with empty string (noop)', pct,
+                                extra=RATE_LIMITED)
+            return ''
+        else:
+            return str(pct) + '%'
+
     def process_rules(self, value):
         """
         Processes rules against the passed in value.
 
         Rules are processed in order, and the first match wins.
 
-        `value` must be of type integer.
+        `value` must be of type integer or float.
 
         """
         try:
@@ -197,27 +510,91 @@ class HeraldThresholds(HeraldBaseRules):
             print('value must be of type int or float! value is {}'.format(value))
             raise
 
+        return self.decide(value)
+
+    def process_rules_bulk(self, values):
+        """
+        Processes rules against a column of values, like an `array('d')`,
+        list or NumPy array, in a single pass per rule.
+
+        Returns two columns, `actions` and `weights`. `actions` holds the
+        action of the first matching rule for each value, 'pct' when the pct
+        rule responds with a weight, '' when pct is greater than 100 (noop)
+        and None when no rule matches. `weights` holds the pct weight, with
+        `min_threshold_response` applied as in `process_rules`, and -1 where
+        there is no weight. `render_bulk` turns them into responses.
+
+        The columns are NumPy arrays when NumPy is installed, lists
+        otherwise.
+
+        """
+        numpy = load_numpy()
+        if numpy is not None:
+            return self._process_rules_numpy(numpy, values)
+
+        actions = []
+        weights = []
+        low = 0
+        for value in values:
+            action, weight = None, -1
+            value = float(value)
+            for rule in self._parsed_rules:
+                if rule.action == 'pct':
+                    pct = int(100 - ((old_div(value, rule.threshold)) * 100))
+                    if pct <= 0:
+                        action, weight = 'pct', int(rule.min_resp)
+                        low += 1
+                        pct_rule = rule
+                    elif pct > 100:
+                        action = ''
+                    else:
+                        action, weight = 'pct', pct
+                    break
+                if rule.op(value, rule.threshold):
+                    action = rule.action
+                    break
+            actions.append(action)
+            weights.append(weight)
+        if low:
+            self._warn_low_pct(low, pct_rule)
+        return actions, weights
+
+    def _warn_low_pct(self, count, rule):
+        self.logger.warning('Pct value less than 0 for %s values, responding '
+                            'with min threshold response %s', count,
+                            rule.min_resp, extra=RATE_LIMITED)
+
+    def _process_rules_numpy(self, numpy, values):
+        values = numpy.asarray(values, dtype=float).reshape(-1)
+        actions = numpy.full(len(values), None, dtype=object)
+        weights = numpy.full(len(values), -1, dtype=numpy.int64)
+        pending = numpy.ones(len(values), dtype=bool)
+
         for rule in self._parsed_rules:
-            action, op, threshold = rule[0], rule[1], rule[2]
-            if action == 'pct':
-                # calculate the percentage of traffic to be sent based on
-                # the threshold. The op value is ignored.
-                pct = int(100 - ((old_div(value, float(threshold))) * 100))
-                if pct <= 0:
-                    min_resp = rule[3]
-                    self.logger.warning('Pct value {} less than 0, responding with min '
-                                        'threshold response {}'.format(pct, min_resp))
-                    return str(min_resp) + '%'
-                # noop if pct is greater than 100
-                elif pct > 100:
-                    self.logger.warning('Pct value {} greater than 100 responding with '
-                                        'empty string (noop)'.format(pct))
-                    return ''
-                else:
-                    return str(pct) + '%'
-            else:
-                # Evaluate the rule and return the action if True
-                if eval('{} {} {}'.format(value, op, threshold)):
-                    return action
-        else:
-            return None
+            if rule.action == 'pct':
+                pct = numpy.trunc(100 - (values / rule.threshold) * 100)
+                low = pending & (pct <= 0)
+                high = pending & (pct > 100)
+                within = pending & ~low & ~high
+                actions[low | within] = 'pct'
+                actions[high] = ''
+                weights[low] = int(rule.min_resp)
+                weights[within] = pct[within].astype(numpy.int64)
+                if low.any():
+                    self._warn_low_pct(low.sum(), rule)
+                break
+
+            matched = pending & rule.op(values, rule.threshold)
+            actions[matched] = rule.action
+            pending &= ~matched
+
+        return actions, weights
+
+    def render_bulk(self, actions, weights):
+        """
+        Returns the list of responses for the columns returned by
+        `process_rules_bulk`, the same as `process_rules` would return.
+
+        """
+        return [str(weight) + '%' if action == 'pct' else action
+                for action, weight in zip(actions, weights)]
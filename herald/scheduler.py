@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import random
+import logging
+import itertools
+import gevent
+from gevent.event import Event
+
+logger = logging.getLogger('Herald')
+
+# golden ratio conjugate, successive multiples of it modulo 1 are spread
+# evenly over [0, 1) however many there are
+PHASE_STEP = 0.6180339887498949
+
+
+class Scheduler(object):
+    """
+    Fixed rate scheduler for plugin polls, independent of the engine.
+
+    Plugins are kept in a heap ordered by their next deadline. A deadline is
+    always the previous one plus the plugin's interval, not the time the
+    poll finished plus the interval, so the period does not drift with the
+    poll duration. Ticks that are missed entirely are skipped, not run back
+    to back.
+
+    When `spread` is set, the first deadline of each plugin is offset by a
+    fraction of its interval so that plugins started together do not all
+    poll on the same tick. Each tick is then delayed by a random
+    0 - `jitter` seconds (or the plugin's own `jitter`), which does not
+    accumulate into the following deadlines.
+
+    The lag of a tick is how late it was popped. The last lag is kept per
+    plugin in `schedule_lag`, and for the scheduler in `lag` and `max_lag`.
+
+    The period of a plugin is its `effective_interval` when it adapts its
+    interval, see `reschedule`.
+
+    Engines subclass this to wait for `next_deadline` and `fire` the
+    plugins returned by `pop_due`. They also poll a plugin out of schedule
+    with `trigger`, and when a file descriptor it `watch`es is readable.
+
+    """
+
+    def __init__(self, jitter=0, spread=True):
+        self.jitter = jitter
+        self.spread = spread
+        # heap of [fire_at, sequence, deadline, period, plugin] entries
+        self.heap = []
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.phases = itertools.count(1)
+        self.ticks = 0
+        self.skipped = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def add(self, plugin, now=None):
+        """
+        Schedule the plugin's polls.
+
+        """
+        now = time.time() if now is None else now
+        deadline = now
+        if self.spread:
+            deadline += (next(self.phases) * PHASE_STEP % 1) * plugin.interval
+        plugin.schedule_lag = 0.0
+        self._push(plugin, deadline)
+        logger.debug('scheduled %s every %ss, first poll in %.3fs',
+                     plugin.name, plugin.interval, deadline - now)
+
+    def remove(self, plugin):
+        """
+        Stop scheduling the plugin's polls.
+
+        """
+        entry = self.entries.pop(plugin, None)
+        if entry is not None:
+            # removed lazily, the entry is skipped when it is popped
+            entry[-1] = None
+
+    def next_deadline(self):
+        """
+        Returns when the next poll is due, or None if nothing is scheduled.
+
+        """
+        while self.heap and self.heap[0][-1] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now=None):
+        """
+        Returns the plugins due at `now` and schedules their next tick.
+
+        """
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, _, deadline, _, plugin = heapq.heappop(self.heap)
+            if plugin is None:
+                continue
+
+            lag = now - fire_at
+            plugin.schedule_lag = lag
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.ticks += 1
+            due.append(plugin)
+
+            interval = self.interval(plugin)
+            deadline += interval
+            if deadline <= now:
+                missed = int((now - deadline) // interval) + 1
+                self.skipped += missed
+                deadline += missed * interval
+            self._push(plugin, deadline, interval)
+        return due
+
+    def reschedule(self, plugin, now=None):
+        """
+        Moves the plugin's next tick to one current interval after its last
+        tick, for when its interval changed.
+
+        """
+        entry = self.entries.get(plugin)
+        if entry is None:
+            return
+        now = time.time() if now is None else now
+        interval = self.interval(plugin)
+        deadline = max(entry[2] - entry[3] + interval, now)
+        self.remove(plugin)
+        self._push(plugin, deadline, interval)
+
+    def interval(self, plugin):
+        """
+        Returns the plugin's current period, its `effective_interval` if it
+        adapts its interval.
+
+        """
+        return getattr(plugin, 'effective_interval', plugin.interval)
+
+    def _push(self, plugin, deadline, interval=None):
+        jitter = getattr(plugin, 'jitter', None)
+        if jitter is None:
+            jitter = self.jitter
+        if interval is None:
+            interval = self.interval(plugin)
+        fire_at = deadline + random.uniform(0, jitter) if jitter else deadline
+        entry = [fire_at, next(self.sequence), deadline, interval, plugin]
+        self.entries[plugin] = entry
+        heapq.heappush(self.heap, entry)
+
+
+class GeventScheduler(Scheduler):
+    """
+    Runs all scheduled polls from a single greenlet.
+
+    Each due plugin is polled in a greenlet of its own, so a slow poll does
+    not delay the others.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(GeventScheduler, self).__init__(*args, **kwargs)
+        self.wakeup = Event()
+        self.greenlets = {}
+        self.watchers = {}
+        self.g = None
+
+    def start(self):
+        self.g = gevent.spawn(self.run)
+
+    def add(self, plugin, now=None):
+        super(GeventScheduler, self).add(plugin, now)
+        self.wakeup.set()
+
+    def reschedule(self, plugin, now=None):
+        super(GeventScheduler, self).reschedule(plugin, now)
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else deadline - time.time()
+            if timeout is None or timeout > 0:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+            for plugin in self.pop_due():
+                self.fire(plugin)
+
+    def fire(self, plugin):
+        greenlet = self.greenlets.get(plugin)
+        if greenlet is not None and not greenlet.dead:
+            # still polling, poll only records the overrun
+            plugin.poll()
+        else:
+            self.greenlets[plugin] = gevent.spawn(plugin.poll)
+
+    def trigger(self, plugin):
+        """
+        Polls the plugin now, out of its schedule.
+
+        """
+        gevent.spawn(self.fire, plugin)
+
+    def watch(self, plugin, fd, callback):
+        """
+        Calls `callback` in a new greenlet whenever `fd` is readable, until
+        the plugin is unwatched.
+
+        """
+        watcher = gevent.get_hub().loop.io(fd, 1)
+        watcher.start(gevent.spawn, callback)
+        self.watchers[plugin] = watcher
+
+    def unwatch(self, plugin):
+        watcher = self.watchers.pop(plugin, None)
+        if watcher is not None:
+            watcher.stop()
+
+    def stop_plugin(self, plugin, timeout):
+        """
+        Unschedules the plugin and waits up to `timeout` seconds for an in
+        progress poll, killing it otherwise. Returns True if it stopped in
+        time.
+
+        """
+        self.remove(plugin)
+        self.unwatch(plugin)
+        greenlet = self.greenlets.pop(plugin, None)
+        if greenlet is None:
+            return True
+        greenlet.join(timeout)
+        if not greenlet.dead:
+            greenlet.kill()
+            return False
+        return True
+
+    def stop(self):
+        if self.g is not None:
+            self.g.kill()
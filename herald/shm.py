@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import struct
+
+# reads tried while a write is in progress, see `seqlock_read`
+READ_RETRIES = 10000
+
+SEQUENCE = struct.Struct('=Q')
+
+
+def seqlock_read(buf, offset, read, retries=READ_RETRIES):
+    """
+    Returns the sequence and result of `read()`, called while the uint64
+    sequence at `offset` in `buf` was even and unchanged before and after
+    the call (seqlock). Returns None if a write was in progress for all the
+    `retries`.
+
+    """
+    for _ in range(retries):
+        before = SEQUENCE.unpack_from(buf, offset)[0]
+        if before & 1:
+            continue
+        data = read()
+        if SEQUENCE.unpack_from(buf, offset)[0] == before:
+            return before, data
+    return None
+
+
+class StateSegment(object):
+    """
+    Shared memory segment holding the rendered state of plugins.
+
+    The segment is an anonymous shared mmap, so it must be created before
+    forking the processes that share it. It is split into fixed size slots,
+    one per plugin, each laid out as :
+
+        sequence   - uint64, odd while a write is in progress
+        timestamp  - float64, time of the last state write
+        length     - uint32, length of the response
+        response   - the rendered response bytes
+
+    There must be a single writer. Readers never lock, they retry until they
+    copy a slot with the same even sequence before and after the copy, see
+    `seqlock_read`.
+
+    """
+
+    SEQUENCE = SEQUENCE
+    HEADER = struct.Struct('=dI')
+    SLOT_SIZE = 256
+
+    @classmethod
+    def slot_size_for(cls, response_size):
+        """
+        Returns the slot size that fits responses of `response_size` bytes.
+
+        """
+        return cls.SEQUENCE.size + cls.HEADER.size + response_size
+
+    def __init__(self, slots, slot_size=SLOT_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_response_size = (slot_size - self.SEQUENCE.size -
+                                  self.HEADER.size)
+        self.mm = mmap.mmap(-1, slots * slot_size)
+
+    def write(self, slot, timestamp, response):
+        """
+        Write the rendered response and its timestamp to slot.
+
+        """
+        if len(response) > self.max_response_size:
+            raise ValueError('response longer than {} bytes: {!r}'.format(
+                self.max_response_size, response))
+
+        offset = slot * self.slot_size
+        data = offset + self.SEQUENCE.size + self.HEADER.size
+        sequence = self.SEQUENCE.unpack_from(self.mm, offset)[0]
+
+        self.SEQUENCE.pack_into(self.mm, offset, sequence + 1)
+        self.HEADER.pack_into(self.mm, offset + self.SEQUENCE.size,
+                              timestamp, len(response))
+        self.mm[data:data + len(response)] = response
+        self.SEQUENCE.pack_into(self.mm, offset, sequence + 2)
+
+    def read(self, slot):
+        """
+        Returns a consistent (timestamp, response) tuple from slot, or None
+        if a write was in progress for all the tries.
+
+        """
+        offset = slot * self.slot_size
+        data = offset + self.SEQUENCE.size + self.HEADER.size
+
+        def read():
+            timestamp, length = self.HEADER.unpack_from(
+                self.mm, offset + self.SEQUENCE.size)
+            return timestamp, self.mm[data:data + min(length,
+                                                      self.max_response_size)]
+
+        read = seqlock_read(self.mm, offset, read)
+        return None if read is None else read[1]
+
+    def close(self):
+        self.mm.close()
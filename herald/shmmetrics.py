@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Binary shared memory metrics, published by an application and read by the
+herald_shm plugin without parsing or syscalls.
+
+The metrics live in a file, usually in /dev/shm, mapped by both sides :
+
+    header    - magic, version, count of slots, retired flag and the
+                uint64 sequence, odd while a write is in progress
+    schema    - count entries of a NUL padded name and a type code, 'd'
+                for float64 or 'q' for int64
+    values    - count 8 byte values, in schema order
+
+This module only depends on the standard library, so applications can
+publish their metrics with it :
+
+>>> from herald.shmmetrics import MetricsWriter
+>>> metrics = MetricsWriter('/dev/shm/myapp.metrics',
+...                         [('msg_rate', 'float64'), ('queued', 'int64')])
+>>> metrics['msg_rate'] = 4200.0
+>>> metrics.update(msg_rate=4300.0, queued=12)
+
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+
+MAGIC = b'HERALDM1'
+VERSION = 1
+
+# magic, version, count, retired, padding and sequence
+HEADER = struct.Struct('=8sIII4xQ')
+SEQUENCE = struct.Struct('=Q')
+SEQUENCE_OFFSET = HEADER.size - SEQUENCE.size
+RETIRED = struct.Struct('=I')
+RETIRED_OFFSET = 16
+
+# name and type code of a slot
+SCHEMA_ENTRY = struct.Struct('=32sc7x')
+NAME_SIZE = 32
+
+TYPES = {'float64': b'd', 'int64': b'q'}
+VALUE_SIZE = 8
+
+
+class Layout(object):
+    """
+    Offsets and formats of a metrics region with the given schema, a list
+    of (name, type code) tuples.
+
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.names = [name for name, _ in schema]
+        self.values_offset = HEADER.size + SCHEMA_ENTRY.size * len(schema)
+        self.values = struct.Struct(
+            '=' + ''.join(code.decode('ascii') for _, code in schema))
+        self.size = self.values_offset + self.values.size
+        self.offsets = dict(
+            (name, self.values_offset + i * VALUE_SIZE)
+            for i, name in enumerate(self.names))
+        self.formats = dict(
+            (name, struct.Struct('=' + code.decode('ascii')))
+            for name, code in schema)
+
+    def pack_header(self, buf):
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, len(self.schema), 0, 0)
+        for i, (name, code) in enumerate(self.schema):
+            SCHEMA_ENTRY.pack_into(buf, HEADER.size + i * SCHEMA_ENTRY.size,
+                                   name.encode('utf-8'), code)
+
+
+def parse_schema(schema):
+    """
+    Validates a writer schema, a list of (name, 'float64' or 'int64')
+    tuples, and returns it with type codes.
+
+    """
+    parsed = []
+    for name, type_name in schema:
+        assert type_name in TYPES, \
+            'type of {} must be one of {}: {}'.format(
+                name, ', '.join(sorted(TYPES)), type_name)
+        assert 0 < len(name.encode('utf-8')) <= NAME_SIZE, \
+            'name must be 1 to {} bytes long: {}'.format(NAME_SIZE, name)
+        parsed.append((name, TYPES[type_name]))
+    assert len(set(name for name, _ in parsed)) == len(parsed), \
+        'duplicate names in schema: {}'.format(schema)
+    return parsed
+
+
+def read_layout(buf):
+    """
+    Returns the layout of the metrics region in `buf`, raising an Exception
+    if it is not one.
+
+    """
+    if len(buf) < HEADER.size:
+        raise Exception('metrics region too short: {} bytes'.format(len(buf)))
+    magic, version, count, _, _ = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise Exception('not a version {} metrics region'.format(VERSION))
+    if len(buf) < HEADER.size + count * SCHEMA_ENTRY.size:
+        raise Exception('metrics region too short for {} slots'.format(count))
+    schema = []
+    for i in range(count):
+        name, code = SCHEMA_ENTRY.unpack_from(
+            buf, HEADER.size + i * SCHEMA_ENTRY.size)
+        if code not in TYPES.values():
+            raise Exception('unknown type code {!r}'.format(code))
+        schema.append((name.rstrip(b'\0').decode('utf-8'), code))
+    layout = Layout(schema)
+    if len(buf) < layout.size:
+        raise Exception('metrics region too short for {} slots'.format(count))
+    return layout
+
+
+class MetricsWriter(object):
+    """
+    Publishes metric values to the file at `path`.
+
+    An existing file with the same schema is reused, keeping its values.
+    Otherwise a new file is renamed over it and the old one marked retired,
+    so readers map the new one.
+
+    Every write bumps the sequence to odd, stores the values and bumps it
+    back to even, so readers never see a partial update (seqlock). There
+    must be a single writer per file.
+
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.layout = Layout(parse_schema(schema))
+        # an old file being replaced, retired once the new one is in place
+        self.replaced = None
+        self.mm = self.open_existing() or self.create()
+
+    def open_existing(self):
+        try:
+            f = open(self.path, 'r+b')
+        except (IOError, OSError):
+            return None
+        with f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0)
+            except (ValueError, OSError):
+                return None
+        try:
+            if read_layout(mm).schema == self.layout.schema:
+                return mm
+        except Exception:
+            pass
+        # readers of the old file switch to the new one
+        if len(mm) >= HEADER.size and mm[:len(MAGIC)] == MAGIC:
+            self.replaced = mm
+        else:
+            mm.close()
+        return None
+
+    def create(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            os.ftruncate(fd, self.layout.size)
+            mm = mmap.mmap(fd, self.layout.size)
+            self.layout.pack_header(mm)
+            os.fchmod(fd, 0o644)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            os.close(fd)
+        if self.replaced is not None:
+            RETIRED.pack_into(self.replaced, RETIRED_OFFSET, 1)
+            self.replaced.close()
+            self.replaced = None
+        return mm
+
+    def set(self, name, value):
+        """
+        Stores a single value.
+
+        """
+        self.store([(self.layout.offsets[name],
+                     self.layout.formats[name].pack(value))])
+
+    __setitem__ = set
+
+    def update(self, *args, **values):
+        """
+        Stores several values, from a dict and/or keyword arguments, readers
+        see all or none of them.
+
+        """
+        values = dict(*args, **values)
+        self.store([(self.layout.offsets[name],
+                     self.layout.formats[name].pack(value))
+                    for name, value in values.items()])
+
+    def store(self, packed):
+        """
+        Copies (offset, bytes) values in a write. They are packed
+        beforehand, so an invalid value raises before readers see the
+        write start.
+
+        """
+        mm = self.mm
+        sequence = SEQUENCE.unpack_from(mm, SEQUENCE_OFFSET)[0]
+        SEQUENCE.pack_into(mm, SEQUENCE_OFFSET, sequence + 1)
+        for offset, data in packed:
+            mm[offset:offset + VALUE_SIZE] = data
+        SEQUENCE.pack_into(mm, SEQUENCE_OFFSET, sequence + 2)
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import tempfile
+from .baseplugin import HeraldPlugin
+
+logger = logging.getLogger('Herald')
+
+# minimum seconds between saves of timestamp only refreshes
+SAVE_INTERVAL = 5
+
+
+class StateSnapshot(object):
+    """
+    Persists the state of the plugins polling with an interval to `path`, so
+    a restarted herald answers with the last known state straight away
+    instead of an empty response until the first poll.
+
+    The snapshot is a small JSON document keyed by plugin name, holding the
+    state timestamp, value and rendered response. It is replaced atomically
+    on every state change, while refreshes of the timestamp alone are saved
+    at most every `save_interval` seconds. The restored timestamp is kept,
+    so an old snapshot is answered with the staleness response as usual.
+
+    """
+
+    def __init__(self, path, plugins, save_interval=SAVE_INTERVAL):
+        self.path = path
+        self.plugins = [p for p in plugins
+                        if isinstance(p, HeraldPlugin) and p.interval]
+        self.save_interval = save_interval
+        self.saved_at = 0
+        self.responses = {}
+
+    def load(self):
+        """
+        Restores the plugins state from the snapshot, if there is one.
+
+        """
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError):
+            return
+        except ValueError as e:
+            logger.warning('ignoring invalid state file %s: %s', self.path, e)
+            return
+
+        for plugin in self.plugins:
+            state = snapshot.get(plugin.name)
+            if not state:
+                continue
+            plugin.state = {'timestamp': state['timestamp'],
+                            'value': state['value'],
+                            'response': state['response'].encode('UTF-8')}
+            self.responses[plugin.name] = plugin.state['response']
+            logger.info('restored %s state from %.0fs ago',
+                        plugin.name, time.time() - state['timestamp'])
+
+    def attach(self):
+        """
+        Saves the snapshot whenever one of the plugins state changes.
+
+        """
+        for plugin in self.plugins:
+            plugin.add_state_listener(self.state_changed)
+
+    def state_changed(self, plugin):
+        if (plugin.state['response'] != self.responses.get(plugin.name) or
+                time.time() - self.saved_at >= self.save_interval):
+            self.save()
+
+    def save(self, sync=False):
+        """
+        Atomically replaces the snapshot with the current plugins state,
+        flushing it to disk if `sync` is set.
+
+        """
+        snapshot = {}
+        for plugin in self.plugins:
+            state = plugin.state
+            snapshot[plugin.name] = {
+                'timestamp': state['timestamp'],
+                'value': state['value'],
+                'response': state['response'].decode('UTF-8')}
+            self.responses[plugin.name] = state['response']
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.herald-state')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f, default=str)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.warning('failed to save state file %s: %s', self.path, e)
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+        self.saved_at = time.time()
+
+
+def load_snapshot(config, plugins):
+    """
+    Restores the plugins state from the `state_file` in config and keeps it
+    updated. Returns the snapshot, or None if no `state_file` is configured.
+
+    """
+    path = config.get('state_file')
+    if not path:
+        return None
+    snapshot = StateSnapshot(path, plugins,
+                             config.get('state_file_interval', SAVE_INTERVAL))
+    snapshot.load()
+    snapshot.attach()
+    return snapshot
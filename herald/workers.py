@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import signal
+import socket
+import logging
+import gevent
+from gevent.server import StreamServer
+from . import logs
+from .shm import StateSegment
+from .baseplugin import HeraldPlugin, render_response
+
+logger = logging.getLogger('Herald')
+
+
+class SharedStateResponder(object):
+    """
+    Answers agent checks for a plugin from the shared state segment.
+
+    Acceptor processes use this in place of the plugin, the plugin itself only
+    runs in the collector process which writes its state to the segment, or
+    its `degraded_response` while it is degraded. Staleness is checked
+    against the timestamp written with the state, and the staleness
+    response is sent if the state could not be read.
+
+    """
+
+    def __init__(self, plugin, segment, slot):
+        self.name = plugin.name
+        self.segment = segment
+        self.slot = slot
+        self.staleness_interval = plugin.staleness_interval
+        self.rendered_staleness_response = plugin.rendered_staleness_response
+
+    def respond_bytes(self):
+        read = self.segment.read(self.slot)
+        if read is None:
+            logger.warning('no consistent read of the %s state, responding '
+                           'stale', self.name, extra=logs.RATE_LIMITED)
+            return self.rendered_staleness_response
+        timestamp, response = read
+        if (self.staleness_interval and
+                time.time() - timestamp > self.staleness_interval):
+            return self.rendered_staleness_response
+        return response
+
+    def __repr__(self):
+        return '<{0}(name="{1}")>'.format(self.__class__.__name__, self.name)
+
+
+def configured_responses(plugin):
+    """
+    Returns the rendered responses set in the plugin config, the rendered
+    states are only known once polled.
+
+    """
+    responses = [plugin.rendered_staleness_response,
+                 plugin.rendered_degraded_response,
+                 render_response(plugin.default_response)]
+    if plugin.breaker_response is not None:
+        responses.append(render_response(plugin.breaker_response))
+    return responses
+
+
+def share_plugins(plugins, slot_size=StateSegment.SLOT_SIZE):
+    """
+    Creates the state segment for the plugins that poll with an interval and
+    returns the list of objects the acceptors should answer with.
+
+    The slots are `slot_size` bytes, or larger if a configured response
+    would not fit. A state response that does not fit is logged and the
+    acceptors answer with the staleness response instead.
+
+    Inline plugins (interval 0) and plugins that do not keep state are
+    answered by the acceptors directly, as in single process mode.
+
+    """
+    shared = [p for p in plugins
+              if isinstance(p, HeraldPlugin) and p.interval]
+    longest = max([len(r) for p in shared for r in configured_responses(p)] +
+                  [0])
+    if StateSegment.slot_size_for(longest) > slot_size:
+        logger.warning('state_slot_size %s is too small for the configured '
+                       'responses, using %s', slot_size,
+                       StateSegment.slot_size_for(longest))
+        slot_size = StateSegment.slot_size_for(longest)
+    segment = StateSegment(max(len(shared), 1), slot_size)
+
+    def publish(slot, plugin):
+        response = plugin.state['response']
+        if plugin.degraded and plugin.degraded_response:
+            response = plugin.rendered_degraded_response
+        if len(response) > segment.max_response_size:
+            # failing here would fail the poll writing the state
+            logger.error('%s response of %s bytes does not fit the %s '
+                         'bytes of state_slot_size %s, responding with the '
+                         'staleness response: %r', plugin.name,
+                         len(response), segment.max_response_size,
+                         slot_size, response, extra=logs.RATE_LIMITED)
+            response = plugin.rendered_staleness_response
+        segment.write(slot, plugin.state['timestamp'], response)
+
+    responders = []
+    for plugin in plugins:
+        if plugin in shared:
+            slot = shared.index(plugin)
+            listener = lambda p, slot=slot: publish(slot, p)
+            plugin.add_state_listener(listener)
+            listener(plugin)
+            responders.append(SharedStateResponder(plugin, segment, slot))
+        else:
+            responders.append(plugin)
+    return responders
+
+
+def reuseport_listener(listen, backlog=1024):
+    """
+    Returns a listening socket bound with SO_REUSEPORT, so every acceptor
+    can bind its own socket to the same address and the kernel spreads the
+    connections between them.
+
+    """
+    assert hasattr(socket, 'SO_REUSEPORT'), \
+        'SO_REUSEPORT is not supported on this platform'
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(listen)
+    sock.listen(backlog)
+    return sock
+
+
+def run_acceptor(listen, handler):
+    """
+    Acceptor process main loop, never returns.
+
+    Exits when signalled or when the collector process goes away.
+
+    """
+    parent = os.getppid()
+    server = StreamServer(reuseport_listener(listen), handler)
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGINT, server.stop)
+    signal_handler(signal.SIGTERM, server.stop)
+
+    def watch_parent():
+        while os.getppid() == parent:
+            gevent.sleep(1)
+        logger.warning('collector process exited, stopping acceptor')
+        server.stop()
+
+    gevent.spawn(watch_parent)
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+
+class WorkerPool(object):
+    """
+    Forks and supervises the acceptor processes.
+
+    The pool has a `stop` method so it can be stopped like a server.
+
+    """
+
+    def __init__(self, listen, workers, handler, stop_timeout=10):
+        self.listen = listen
+        self.workers = workers
+        self.handler = handler
+        self.stop_timeout = stop_timeout
+        self.pids = []
+
+    def start(self):
+        """
+        Forks the acceptors. This must be called before any plugin is
+        started, forked processes would otherwise inherit their greenlets.
+
+        """
+        for _ in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                logs.after_fork()
+                run_acceptor(self.listen, self.handler)
+            self.pids.append(pid)
+        logger.info('started %s acceptors listening %s: %s',
+                    self.workers, self.listen, self.pids)
+
+    def stop(self):
+        """
+        Terminates the acceptors and waits for them to exit.
+
+        """
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        with gevent.Timeout(self.stop_timeout, False):
+            for pid in list(self.pids):
+                try:
+                    os.waitpid(pid, 0)
+                except OSError as e:
+                    if e.errno != errno.ECHILD:
+                        raise
+                self.pids.remove(pid)
+        for pid in self.pids:
+            logger.warning('acceptor %s did not stop, killing', pid)
+            os.kill(pid, signal.SIGKILL)
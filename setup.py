@@ -17,10 +17,20 @@ setup(name='haproxy-herald',
                         'psutil>=5.4.6',
                         'future>=0.16.0',
                         ],
+      extras_require={
+          'bulk': ['numpy'],
+          'json': ['orjson'],
+      },
       package_data={'herald.plugins': ['*.py']},
       entry_points={
           'console_scripts': [
               'herald = herald.herald:main'
+          ],
+          'herald.plugins': [
+              'herald_file = herald.plugins.fileplugin:FilePlugin',
+              'herald_http = herald.plugins.httpplugin:HTTPPlugin',
+              'herald_syscall = herald.plugins.syscallplugin:SyscallPlugin',
+              'herald_shm = herald.plugins.shmplugin:SharedMemoryPlugin',
           ]
       },
       keywords=['Haproxy']
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from herald.projection import Projection, build_tree
+from herald.rules import metric_key_paths
+
+
+def project(value, tree):
+    """
+    What a projection of `tree` should return for the decoded `value`.
+
+    """
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, subtree in tree.items():
+        if key in value:
+            if subtree is not None and isinstance(value[key], dict):
+                result[key] = project(value[key], subtree)
+            else:
+                result[key] = value[key]
+    return result
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def assertProjects(self, paths, text):
+        projection = Projection(paths)
+        self.assertEqual(projection.loads(text),
+                         project(json.loads(text), projection.tree))
+
+    def test_top_level_keys(self):
+        text = '{"a": 1, "b": "two", "c": [3], "d": null}'
+        self.assertEqual(Projection({('b',), ('d',)}).loads(text),
+                         {'b': 'two', 'd': None})
+        self.assertProjects({('a',), ('c',)}, text)
+
+    def test_nested_keys(self):
+        text = json.dumps({'queues': {'msg-rate': 4200, 'depth': 7,
+                                      'consumers': {'count': 3}},
+                           'backlog': 12, 'other': {'msg-rate': 1}})
+        self.assertEqual(
+            Projection({('queues', 'msg-rate'), ('backlog',)}).loads(text),
+            {'queues': {'msg-rate': 4200}, 'backlog': 12})
+        self.assertProjects({('queues', 'consumers', 'count')}, text)
+        self.assertProjects({('queues',), ('queues', 'depth')}, text)
+
+    def test_nested_key_of_a_non_object(self):
+        self.assertProjects({('a', 'b')}, '{"a": [1, 2], "c": 3}')
+        self.assertProjects({('a', 'b')}, '{"a": 5}')
+
+    def test_arrays(self):
+        text = ('{"skip": [{"a": 1}, [2, [3]], "]"], '
+                '"hosts": [{"rate": 1.5}, {"rate": 2}], "n": []}')
+        self.assertEqual(Projection({('hosts',), ('n',)}).loads(text),
+                         {'hosts': [{'rate': 1.5}, {'rate': 2}], 'n': []})
+
+    def test_escapes(self):
+        text = (r'{"k\"ey": "{\"a\": 1}", "unïcode": "café", '
+                r'"a": "x\\", "b\nc": 2}')
+        self.assertProjects({('k"ey',), ('unïcode',)}, text)
+        self.assertProjects({('a',), ('b\nc',)}, text)
+
+    def test_missing_keys(self):
+        text = '{"a": 1, "b": {"c": 2}}'
+        self.assertEqual(Projection({('x',), ('b', 'y')}).loads(text),
+                         {'b': {}})
+        self.assertProjects({('x',), ('a',)}, text)
+        self.assertEqual(Projection({('a',)}).loads('{}'), {})
+
+    def test_whitespace(self):
+        text = ' \n{ "a" :\t1 ,\r\n "b" : { "c" : [ 1 , 2 ] } }\n'
+        self.assertProjects({('b', 'c')}, text)
+        self.assertProjects({('a',), ('x',)}, text)
+
+    def test_not_an_object(self):
+        for text in ('[1, {"a": 2}]', '42', '"up"', 'null'):
+            self.assertEqual(Projection({('a',)}).loads(text),
+                             json.loads(text))
+
+    def test_stops_after_the_wanted_keys(self):
+        # the document is not scanned past the last wanted key
+        self.assertEqual(Projection({('a',)}).loads('{"a": 1, "b": oops'),
+                         {'a': 1})
+
+    def test_malformed(self):
+        projection = Projection({('a',), ('z',)})
+        for text in ('{"a" 1}', '{"a": }', '{a: 1}', '{"a": 1 "z": 2}',
+                     '{"a": 1,', '{"b": [1, 2}'):
+            self.assertRaises(ValueError, projection.loads, text)
+
+    def test_metric_key_paths(self):
+        paths = metric_key_paths("r['queues']['msg-rate'] * 2 + r['l'][0]")
+        text = '{"l": [5, 6], "queues": {"msg-rate": 3}, "z": 0}'
+        self.assertEqual(Projection(paths).loads(text),
+                         {'l': [5, 6], 'queues': {'msg-rate': 3}})
+
+    def test_build_tree(self):
+        self.assertEqual(build_tree({('a', 'b'), ('a', 'c'), ('d',)}),
+                         {'a': {'b': None, 'c': None}, 'd': None})
+        # a whole value wins over its subkeys
+        self.assertEqual(build_tree({('a', 'b'), ('a',)}), {'a': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
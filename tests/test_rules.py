@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from array import array
+from herald import rules
+from herald.rules import HeraldThresholds, HeraldPatterns
+
+# thresholds covering every operator, with values on, around and between
+# the thresholds
+THRESHOLD_RULES = [
+    [{'down': 0}, {'drain': '>7000'}, {'up': '<7000'}],
+    [{'down': '=0'}, {'maint': '!5'}, {'up': '5'}],
+    [{'drain': '>40.5'}, {'up': '<10.25'}],
+    [{'down': 0}, {'drain': '>9000'}, {'pct': 7000}],
+    [{'pct': 7000, 'min_threshold_response': 5}, {'down': 0}],
+    [{'pct': 0.5}],
+]
+
+VALUES = [0, 0.0, 1, 4.999, 5, 5.001, 10.25, 10.2501, 40.5, 40.50001, 69.99,
+          70, 3500, 6999.9, 7000, 7000.1, 9000, 9001, 1e9, -1, -0.5, -7000,
+          0.25, 0.5, 0.75]
+
+
+class BulkRulesTest(object):
+    """
+    Checks the bulk paths give what `process_rules` gives for each value,
+    with or without NumPy depending on `use_numpy`.
+
+    """
+
+    use_numpy = False
+
+    def setUp(self):
+        self.numpy = rules.NUMPY
+        if self.use_numpy:
+            if rules.load_numpy() is None:
+                self.skipTest('numpy is not installed')
+        else:
+            rules.NUMPY = False
+
+    def tearDown(self):
+        rules.NUMPY = self.numpy
+
+    def test_thresholds(self):
+        for rule in THRESHOLD_RULES:
+            ht = HeraldThresholds(rule, 'r')
+            actions, weights = ht.process_rules_bulk(VALUES)
+            self.assertEqual(ht.render_bulk(actions, weights),
+                             [ht.process_rules(v) for v in VALUES],
+                             'rules {}'.format(rule))
+
+    def test_thresholds_columns(self):
+        ht = HeraldThresholds([{'down': 0}, {'pct': 100}], 'r')
+        for values in (array('d', VALUES), tuple(VALUES)):
+            actions, weights = ht.process_rules_bulk(values)
+            self.assertEqual(ht.render_bulk(actions, weights),
+                             [ht.process_rules(v) for v in VALUES])
+
+    def test_thresholds_weights(self):
+        ht = HeraldThresholds([{'down': 0}, {'pct': 100,
+                                             'min_threshold_response': 3}],
+                              'r')
+        actions, weights = ht.process_rules_bulk([0, 25, 100, 150, -50])
+        self.assertEqual(list(actions), ['down', 'pct', 'pct', 'pct', ''])
+        self.assertEqual(list(weights), [-1, 75, 3, 3, -1])
+
+    def test_thresholds_low_pct_warning(self):
+        ht = HeraldThresholds([{'pct': 100}], 'r')
+        with self.assertLogs(ht.logger, 'WARNING') as logs:
+            ht.process_rules_bulk([5, 200, 300])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('less than 0 for 2 values', logs.output[0])
+
+    def test_thresholds_no_match(self):
+        ht = HeraldThresholds([{'up': '<10'}], 'r')
+        actions, weights = ht.process_rules_bulk([10, 11])
+        self.assertEqual(ht.render_bulk(actions, weights), [None, None])
+
+    def test_thresholds_empty(self):
+        ht = HeraldThresholds([{'pct': 100}], 'r')
+        actions, weights = ht.process_rules_bulk([])
+        self.assertEqual(ht.render_bulk(actions, weights), [])
+
+    def test_patterns(self):
+        hp = HeraldPatterns([{'down': 'fail.*'}, {'drain': 'maint'},
+                             {'up': 'ok|healthy'}], 'r')
+        values = ['ok', 'failed', 'maint', 'maintenance', 'healthy', 'nope',
+                  '', 'ok', 'failed']
+        self.assertEqual(list(hp.process_rules_bulk(values)),
+                         [hp.process_rules(v) for v in values])
+
+    def test_patterns_non_string_values(self):
+        hp = HeraldPatterns([{'down': '0'}, {'up': '1'}], 'r')
+        values = [0, 1, 2, 10]
+        self.assertEqual(list(hp.process_rules_bulk(values)),
+                         [hp.process_rules(v) for v in values])
+
+
+class PythonBulkRulesTest(BulkRulesTest, unittest.TestCase):
+    use_numpy = False
+
+
+class NumpyBulkRulesTest(BulkRulesTest, unittest.TestCase):
+    use_numpy = True
+
+
+if __name__ == '__main__':
+    unittest.main()